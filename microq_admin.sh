@@ -1,2 +1,4 @@
 #! /usr/bin/env bash
-docker run --rm -v ~/odin.cfg:/odin.cfg:ro odinsmr/microq_admin "$@"
+mkdir -p ~/.microq_admin
+docker run --rm -v ~/odin.cfg:/odin.cfg:ro \
+    -v ~/.microq_admin:/root/.microq_admin odinsmr/microq_admin "$@"
@@ -0,0 +1,140 @@
+import gzip
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from ..utils import STATE_DIR
+
+CACHE_DIR = os.path.join(STATE_DIR, 'cache')
+# Size cap of the cached response bodies in bytes
+CACHE_MAX_SIZE = 2 * 1024 ** 3
+# Seconds before responses that may still change are fetched again
+CACHE_TTL = 24 * 3600
+
+
+class ResponseCache:
+    """On disk cache of odin api JSON responses keyed by URL.
+
+    The bodies are stored as gzip compressed files, indexed by a SQLite
+    database. Immutable entries, e.g. the logs of days that are older than
+    the latest ecmf data, are kept until they are evicted, others expire
+    after ttl seconds. When the bodies take more than max_size bytes the
+    least recently used entries are evicted.
+
+    With refresh, cached entries are not used but responses are still
+    stored.
+    """
+
+    def __init__(self, directory=CACHE_DIR, max_size=CACHE_MAX_SIZE,
+                 ttl=CACHE_TTL, refresh=False):
+        self.directory = directory
+        self.max_size = max_size
+        self.ttl = ttl
+        self.refresh = refresh
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        self._db = sqlite3.connect(
+            os.path.join(directory, 'index.sqlite'), timeout=60,
+            check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'url TEXT PRIMARY KEY, file TEXT NOT NULL, size INTEGER NOT NULL,'
+            ' fetched REAL NOT NULL, accessed REAL NOT NULL,'
+            ' immutable INTEGER NOT NULL)')
+        self._db.execute(
+            'CREATE INDEX IF NOT EXISTS entries_accessed '
+            'ON entries (accessed)')
+
+    def get(self, url):
+        """Return the cached JSON response for url, None if it is not
+        cached or has expired
+        """
+        inp = self.open(url)
+        if inp is None:
+            return None
+        try:
+            with inp:
+                return json.loads(inp.read())
+        except (OSError, EOFError, ValueError):
+            return None
+
+    def open(self, url):
+        """Return binary file object of the cached response body for url,
+        None if it is not cached or has expired
+        """
+        if self.refresh:
+            return None
+        with self._lock:
+            row = self._db.execute(
+                'SELECT file, fetched, immutable FROM entries WHERE url = ?',
+                (url,)).fetchone()
+            if row is None:
+                return None
+            name, fetched, immutable = row
+            if not immutable and fetched + self.ttl < time.time():
+                return None
+            self._db.execute(
+                'UPDATE entries SET accessed = ? WHERE url = ?',
+                (time.time(), url))
+        try:
+            return gzip.open(os.path.join(self.directory, name))
+        except OSError:
+            return None
+
+    def put(self, url, content, immutable=False):
+        """Store the JSON response body content for url"""
+        with self.writer(url, immutable) as out:
+            out.write(content)
+
+    @contextmanager
+    def writer(self, url, immutable=False):
+        """Context manager of a binary file object that the response body
+        for url is written to, e.g. chunk by chunk. The entry is stored
+        when the context exits without an exception.
+        """
+        name = hashlib.sha1(url.encode('utf8')).hexdigest() + '.json.gz'
+        path = os.path.join(self.directory, name)
+        tmp_path = '{}.{}.{}.tmp'.format(
+            path, os.getpid(), threading.get_ident())
+        try:
+            with gzip.open(tmp_path, 'wb') as out:
+                yield out
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        size = os.path.getsize(tmp_path)
+        with self._lock:
+            os.replace(tmp_path, path)
+            now = time.time()
+            self._db.execute(
+                'INSERT OR REPLACE INTO entries '
+                '(url, file, size, fetched, accessed, immutable) '
+                'VALUES (?, ?, ?, ?, ?, ?)',
+                (url, name, size, now, now, int(immutable)))
+            self._evict()
+
+    def _evict(self):
+        total = self._db.execute(
+            'SELECT COALESCE(SUM(size), 0) FROM entries').fetchone()[0]
+        if total <= self.max_size:
+            return
+        evicted = []
+        for url, name, size in self._db.execute(
+                'SELECT url, file, size FROM entries ORDER BY accessed'):
+            if total <= self.max_size:
+                break
+            evicted.append((url, name))
+            total -= size
+        for url, name in evicted:
+            self._db.execute('DELETE FROM entries WHERE url = ?', (url,))
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except FileNotFoundError:
+                pass
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,138 @@
+import json
+from collections.abc import Sequence
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(obj):
+    """Return obj as JSON bytes, encoded by orjson if it is installed"""
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(',', ':')).encode('utf8')
+
+
+def encode_jobs(jobs):
+    """Return the JSON body for a JobBatch or a list of job dicts"""
+    if isinstance(jobs, (JobBatch, EncodedBatch)):
+        return jobs.encode()
+    return dumps(jobs)
+
+
+def _open_string(text):
+    """Return text as the start of a JSON string, without the end quote"""
+    return dumps(text)[:-1]
+
+
+class JobTemplate:
+    """The parts of the qsmr jobs that are the same for every scan in a
+    project and freqmode, pre-encoded as JSON so that a job only costs a
+    join of a few byte strings.
+    """
+    __slots__ = (
+        'job_type', 'odin_api_root', 'odin_project', 'freqmode', '_parts')
+
+    def __init__(self, job_type, odin_api_root, odin_project, freqmode):
+        self.job_type = job_type
+        self.odin_api_root = odin_api_root
+        self.odin_project = odin_project
+        self.freqmode = freqmode
+        self._parts = (
+            b'{"id":' + _open_string('%s:' % freqmode),
+            b'","type":' + dumps(job_type) + b',"source_url":' + _open_string(
+                '{}/v4/l1_log/{}/'.format(odin_api_root, freqmode)),
+            b'/","target_url":' + _open_string(
+                odin_api_root + '/v5/level2?d='),
+            b'","view_result_url":' + _open_string(
+                '{}/v5/level2/development/{}/{}/'.format(
+                    odin_api_root, odin_project, freqmode)),
+            b'"}',
+        )
+
+    def job(self, scanid, target):
+        """Return the job for a scan id and encoded level2 target parameter
+        as a dict
+        """
+        return {
+            'id': '%s:%s' % (self.freqmode, scanid),
+            'type': self.job_type,
+            'source_url': (
+                self.odin_api_root + '/v4/l1_log/{freqmode}/{scanid}/'.format(
+                    scanid=scanid, freqmode=self.freqmode)),
+            'target_url': self.odin_api_root + '/v5/level2?d={}'.format(
+                target),
+            'view_result_url': (
+                self.odin_api_root +
+                '/v5/level2/development/{project}/{freqmode}/{scanid}'.format(
+                    project=self.odin_project, freqmode=self.freqmode,
+                    scanid=scanid
+                ))
+        }
+
+    def encode(self, scanids, targets):
+        """Return the JSON array of the jobs for the scan ids and encoded
+        level2 target parameters
+        """
+        return b'[' + b','.join(self.encode_lines(scanids, targets)) + b']'
+
+    def encode_lines(self, scanids, targets):
+        """Return list of the jobs for the scan ids and encoded level2
+        target parameters, each job as a JSON object
+        """
+        id_start, source_start, target_start, view_start, end = self._parts
+        jobs = []
+        append = jobs.append
+        for scanid, target in zip(scanids, targets):
+            scanid = b'%d' % int(scanid)
+            append(b''.join((
+                id_start, scanid, source_start, scanid, target_start,
+                target.encode('ascii'), view_start, scanid, end)))
+        return jobs
+
+
+class JobBatch(Sequence):
+    """A batch of jobs kept as scan ids and encoded level2 target
+    parameters.
+
+    Items are job dicts built on access, encode() returns the JSON body
+    without building any dicts.
+    """
+    __slots__ = ('template', 'scanids', 'targets')
+
+    def __init__(self, template, scanids, targets):
+        self.template = template
+        self.scanids = scanids
+        self.targets = targets
+
+    def __len__(self):
+        return len(self.scanids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return JobBatch(
+                self.template, self.scanids[index], self.targets[index])
+        return self.template.job(self.scanids[index], self.targets[index])
+
+    def encode(self):
+        return self.template.encode(self.scanids, self.targets)
+
+    def encode_lines(self):
+        return self.template.encode_lines(self.scanids, self.targets)
+
+
+class EncodedBatch:
+    """A batch of jobs that are already encoded, one JSON object per job,
+    e.g. read back from a spool.
+    """
+    __slots__ = ('lines',)
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def __len__(self):
+        return len(self.lines)
+
+    def encode(self):
+        return b'[' + b','.join(self.lines) + b']'
@@ -0,0 +1,92 @@
+import os
+
+from .scanidset import ScanIDSet
+from ..utils import STATE_DIR
+
+JOURNAL_DIR = os.path.join(STATE_DIR, 'journal')
+# First and last field of the rows of acknowledged batches
+BATCH = 'batch'
+END = 'end'
+
+
+def append_row(path, row):
+    """Append a row to the file and sync it. A last row that a crash left
+    without its newline is ended first, so the new row stays readable.
+    """
+    with open(path, 'a+b') as out:
+        end = out.seek(0, os.SEEK_END)
+        if end:
+            out.seek(end - 1)
+            if out.read(1) != b'\n':
+                row = '\n' + row
+        out.write(row.encode())
+        out.flush()
+        os.fsync(out.fileno())
+
+
+class Journal:
+    """Append-only journal of the job batches that the job service has
+    acknowledged for one project and freqmode.
+
+    Each row holds the number of jobs in an acknowledged batch and their
+    scan ids, between the BATCH and END markers, so resuming skips exactly
+    those scan ids whatever the order of the source. Rows of older
+    journals, that only held the range of each batch, are ignored.
+    """
+
+    def __init__(self, project, freqmode, directory=JOURNAL_DIR):
+        self.path = os.path.join(
+            directory, '{}-{}.journal'.format(project, freqmode))
+        os.makedirs(directory, exist_ok=True)
+
+    def record(self, scanids):
+        """Append an acknowledged batch of scan ids to the journal"""
+        scanids = [int(scanid) for scanid in scanids]
+        append_row(self.path, '%s %d %s %s\n' % (
+            BATCH, len(scanids), ' '.join(map(str, scanids)), END))
+
+    def _generate_acknowledged(self):
+        with open(self.path) as inp:
+            for row in inp:
+                fields = row.split()
+                # The last row may be incomplete after a crash
+                if (len(fields) < 3 or fields[0] != BATCH
+                        or fields[-1] != END
+                        or len(fields) != int(fields[1]) + 3):
+                    continue
+                for scanid in fields[2:-1]:
+                    yield int(scanid)
+
+    def acknowledged(self):
+        """Return ScanIDSet of the scan ids of the acknowledged batches"""
+        if not os.path.exists(self.path):
+            return ScanIDSet()
+        return ScanIDSet(self._generate_acknowledged())
+
+    def filter(self, scanids):
+        """Generate the scan ids that are not in an acknowledged batch,
+        the number of skipped ids is kept in self.nr_skipped.
+        """
+        acknowledged = self.acknowledged()
+        self.nr_skipped = 0
+        for scanid in scanids:
+            if int(scanid) in acknowledged:
+                self.nr_skipped += 1
+                continue
+            yield scanid
+
+
+class DeadLetters:
+    """File of the scan ids of batches that could not be added, one scan id
+    per row so that it can be replayed as a jobs file.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.nr_batches = 0
+
+    def record(self, scanids):
+        """Append a failed batch of scan ids to the file"""
+        with open(self.path, 'a') as out:
+            out.write(''.join('%d\n' % int(scanid) for scanid in scanids))
+        self.nr_batches += 1
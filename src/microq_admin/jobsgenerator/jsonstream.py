@@ -0,0 +1,103 @@
+import codecs
+import json
+
+# Bytes read at a time from a streamed JSON document
+CHUNK_SIZE = 64 * 1024
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = ' \t\n\r'
+_DELIMITERS = _WHITESPACE + ',:]}'
+
+
+class _JSONStream:
+    """Incremental reader of a JSON document from chunks of bytes, only the
+    unread part of the latest chunks is kept in memory.
+    """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._decoder = codecs.getincrementaldecoder('utf8')()
+        self._buf = ''
+        self._pos = 0
+        self._eof = False
+
+    def _more(self):
+        if self._eof:
+            raise ValueError('Unexpected end of JSON document')
+        chunk = next(self._chunks, None)
+        if chunk is None:
+            self._eof = True
+            text = self._decoder.decode(b'', final=True)
+        else:
+            text = self._decoder.decode(chunk)
+        self._buf = self._buf[self._pos:] + text
+        self._pos = 0
+
+    def peek(self):
+        """Return the next character that is not whitespace"""
+        while True:
+            while (self._pos < len(self._buf)
+                   and self._buf[self._pos] in _WHITESPACE):
+                self._pos += 1
+            if self._pos < len(self._buf):
+                return self._buf[self._pos]
+            self._more()
+
+    def expect(self, chars):
+        """Consume and return the next character, one of chars"""
+        char = self.peek()
+        if char not in chars:
+            raise ValueError('Expected one of %r at %r' % (
+                chars, self._buf[self._pos:self._pos + 20]))
+        self._pos += 1
+        return char
+
+    def value(self):
+        """Consume and return the next JSON value"""
+        self.peek()
+        while True:
+            try:
+                value, end = _DECODER.raw_decode(self._buf, self._pos)
+            except ValueError:
+                if self._eof:
+                    raise
+                self._more()
+                continue
+            # A number cut by the end of the buffer may continue in the
+            # next chunk, in a valid document a value is followed by a
+            # delimiter
+            if not self._eof and (
+                    end == len(self._buf)
+                    or self._buf[end] not in _DELIMITERS):
+                self._more()
+                continue
+            self._pos = end
+            return value
+
+
+def iter_json_array(chunks, key):
+    """Generate the items of the array under key in the JSON object read
+    from chunks of bytes, parsing one item at a time.
+
+    Values before the array are parsed and dropped, the rest of the
+    document after the array is not read. Nothing is generated if there is
+    no such key.
+    """
+    stream = _JSONStream(chunks)
+    stream.expect('{')
+    if stream.peek() == '}':
+        return
+    while True:
+        name = stream.value()
+        stream.expect(':')
+        if name == key:
+            stream.expect('[')
+            if stream.peek() == ']':
+                return
+            while True:
+                yield stream.value()
+                if stream.expect(',]') == ']':
+                    return
+        stream.value()
+        if stream.expect(',}') == '}':
+            return
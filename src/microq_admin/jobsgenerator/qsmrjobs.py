@@ -1,24 +1,68 @@
 import json
+import gzip
 import base64
 import argparse
+import random
+import threading
+import time
 from sys import stderr
 from collections import defaultdict
-from io import BytesIO
+from concurrent.futures import (
+    ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait)
+from contextlib import nullcontext
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta
+from itertools import count, islice, repeat
 
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
 
 from Crypto.Cipher import AES
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
-from .scanids import ScanIDs
+from .cache import CACHE_DIR, CACHE_MAX_SIZE, ResponseCache
+from .jobrecords import JobBatch, JobTemplate, encode_jobs
+from .journal import JOURNAL_DIR, DeadLetters, Journal
+from .jsonstream import CHUNK_SIZE, iter_json_array
+from .scanids import (
+    FREQMODE_TO_BACKEND, PREFETCH_DAYS, OdinAPIError, ScanIDs,
+)
+from .scanidset import ScanIDSet
+from .spool import Spool, SpoolError
+from .. import ratelimit
+from ..state import STATE_FILE, Watermarks
+from ..tokens import RENEW_MARGIN, TokenError, TokenManager
 from ..utils import load_config, validate_config, validate_project_name
 
+# Name of the --since-last watermarks in the state file
+WATERMARK = 'qsmrjobs_last_day'
 NUMBER_OF_JOBS_TO_POST = 1000
+MIN_JOBS_TO_POST = 100
+MAX_JOBS_TO_POST = 10000
+TARGET_POST_LATENCY = 10
+# Retries of a batch post after transient errors
+RETRIES = 3
+RETRY_BACKOFF = 1
+MAX_RETRY_DELAY = 300
+RETRY_STATUS_CODES = (429, 502, 503, 504)
+# Seconds to wait for a connection to the job service and for each chunk
+# of the streamed list of the jobs in a project
+GET_JOBS_TIMEOUT = (10, 120)
+COMPRESSION_LEVELS = {'gzip': 6, 'zstd': 3}
+# Number of target parameters encoded per task in the encryption process pool
+ENCODE_CHUNK_SIZE = 250
 
 DESCRIPTION = ("Add qsmr jobs to the microq job service.\n"
                "Choose between adding all scans in the freqmode, all scans "
                "between two timestamps or all scans in the vds dataset.\n"
                "If no jobs arguments are provided, the configuration and "
-               "project name are validated.")
+               "project name are validated.\n"
+               "With --spool the jobs are written to a directory instead of "
+               "being posted, they can be posted later, e.g. from another "
+               "host, with --upload.")
 
 
 def make_argparser(prog):
@@ -33,7 +77,10 @@ def make_argparser(prog):
             'and digits and start with an ascii letter'))
     parser.add_argument('ODIN_PROJECT', help=(
         'the project name used in the odin api'))
-    parser.add_argument('--freq-mode', help='freq mode of the jobs')
+    parser.add_argument('--freq-mode', help=(
+        'freq mode of the jobs, a comma separated list of freq modes or '
+        '"all" for all freq modes, several freq modes are added '
+        'concurrently and share the --concurrency limit'))
     parser.add_argument('--all', action='store_true', help=(
         'add all scan ids for this freq mode'))
     parser.add_argument('--start-day', help=(
@@ -42,12 +89,100 @@ def make_argparser(prog):
     parser.add_argument('--end-day', help=(
         'together with --all, only add scans up to this day '
         '(yyyy-mm-dd, exclusive)'))
+    parser.add_argument('--since-last', action='store_true', help=(
+        'together with --all, only add scans from the days after the last '
+        'day of the latest successful --since-last run for this project '
+        'and freq mode, or from --start-day if there is none'))
+    parser.add_argument('--state-file', default=STATE_FILE, help=(
+        'file of the --since-last watermarks (default: %(default)s)'))
     parser.add_argument('--vds', action='store_true', help=(
         'add all scan ids in the vds dataset for this freq mode'))
+    parser.add_argument(
+        '--prefetch-days', type=int, default=PREFETCH_DAYS, help=(
+            'together with --all, number of period info windows and day '
+            'logs to fetch concurrently from the odin api, the scan ids are '
+            'still added in order '
+            '(default: %(default)s)'))
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help=(
+        'directory of the cache of scan catalog responses from the odin api '
+        '(default: %(default)s)'))
+    parser.add_argument(
+        '--cache-size', type=int, default=CACHE_MAX_SIZE // 1024 ** 2, help=(
+            'size cap of the cache in MiB, the least recently used '
+            'responses are evicted (default: %(default)s)'))
+    parser.add_argument('--no-cache', action='store_true', help=(
+        'fetch the scan catalog from the odin api without using the cache'))
+    parser.add_argument('--refresh-cache', action='store_true', help=(
+        'fetch the scan catalog from the odin api and replace the cached '
+        'responses'))
     parser.add_argument('--jobs-file', help=(
-        'add the scan ids in this file, one scan id per row'))
+        'add the scan ids in this file, a text file with one scan id per '
+        'row that may be compressed (.gz, .xz, .zst), or a binary file with '
+        'a little-endian uint64 array, raw (.u64) or in numpy format (.npy)'))
     parser.add_argument('--skip', help=(
-        'number of rows to skip in the jobs file'))
+        'number of rows to skip in the jobs file, a seek in binary files'))
+    parser.add_argument('--concurrency', type=int, default=1, help=(
+        'number of job batches to post concurrently (default: 1)'))
+    parser.add_argument('--encrypt-processes', type=int, default=1, help=(
+        'number of processes used to encrypt the level2 target '
+        'parameters (default: 1)'))
+    parser.add_argument('--adaptive-batch-size', action='store_true', help=(
+        'adapt the number of jobs per post to the observed post latency, '
+        'grow while posts are faster than --target-latency and shrink on '
+        'timeouts and server errors'))
+    parser.add_argument(
+        '--min-batch-size', type=int, default=MIN_JOBS_TO_POST, help=(
+            'together with --adaptive-batch-size, the smallest number of '
+            'jobs per post (default: %(default)s)'))
+    parser.add_argument(
+        '--max-batch-size', type=int, default=MAX_JOBS_TO_POST, help=(
+            'together with --adaptive-batch-size, the largest number of '
+            'jobs per post (default: %(default)s)'))
+    parser.add_argument(
+        '--target-latency', type=float, default=TARGET_POST_LATENCY, help=(
+            'together with --adaptive-batch-size, the wanted duration of a '
+            'post in seconds (default: %(default)s)'))
+    parser.add_argument('--post-timeout', type=float, help=(
+        'seconds to wait for the job service to answer a post'))
+    parser.add_argument('--compress', choices=('gzip', 'zstd'), help=(
+        'compress the posted job batches, zstd needs the zstandard package, '
+        'falls back to uncompressed posts if the job service answers 415'))
+    parser.add_argument('--compress-level', type=int, help=(
+        'compression level (default: {})'.format(', '.join(
+            '{} for {}'.format(level, compression)
+            for compression, level in COMPRESSION_LEVELS.items()))))
+    parser.add_argument('--retries', type=int, default=RETRIES, help=(
+        'number of times to retry a batch post after a connection error, '
+        'timeout or status code {} (default: %(default)s)'.format(
+            ', '.join(map(str, RETRY_STATUS_CODES)))))
+    parser.add_argument(
+        '--retry-backoff', type=float, default=RETRY_BACKOFF, help=(
+            'base delay in seconds between retries, doubled for each retry '
+            'and jittered, Retry-After from the job service takes '
+            'precedence (default: %(default)s)'))
+    parser.add_argument('--dead-letter', help=(
+        'append the scan ids of batches that still fail after all retries '
+        'to this file and continue with the remaining batches, the file can '
+        'be replayed with --jobs-file'))
+    parser.add_argument('--skip-existing', action='store_true', help=(
+        'fetch the jobs already in the project and only add the missing '
+        'ones'))
+    parser.add_argument('--exclude-file', help=(
+        'do not add the scan ids in this file, in any of the --jobs-file '
+        'formats'))
+    parser.add_argument('--journal-dir', default=JOURNAL_DIR, help=(
+        'directory of the journals of acknowledged job batches, one per '
+        'project and freq mode (default: %(default)s)'))
+    parser.add_argument('--resume', action='store_true', help=(
+        'skip the scan ids that the journal recorded as acknowledged by '
+        'the job service in earlier runs, in any order'))
+    parser.add_argument('--spool', metavar='DIR', help=(
+        'write the job batches to this directory, as gzip compressed '
+        'files with one job per row and a manifest, instead of posting '
+        'them'))
+    parser.add_argument('--upload', metavar='DIR', help=(
+        'post the job batches spooled to this directory with --spool, '
+        'batches that were uploaded by an earlier run are skipped'))
     return parser
 
 
@@ -66,37 +201,241 @@ def main(args=None, config_file=None, prog=None):
     config = load_config(config_file)
     if not validate_config(config):
         return 1
-    if not args.freq_mode:
+    ratelimit.configure(config)
+    if args.upload:
+        if args.spool or any([args.vds, args.all, args.jobs_file]):
+            stderr.write('--upload can not be combined with adding jobs\n')
+            return 1
+    elif not args.freq_mode:
         return 0
-    if not any([args.vds, args.all, args.jobs_file]):
+    elif not any([args.vds, args.all, args.jobs_file]):
         return 0
 
-    freqmode = int(args.freq_mode)
+    if args.concurrency < 1:
+        stderr.write('Concurrency must be at least 1\n')
+        return 1
+    if args.compress == 'zstd' and zstandard is None:
+        stderr.write('Install zstandard to use zstd compression\n')
+        return 1
+    if args.retries < 0:
+        stderr.write('Number of retries must not be negative\n')
+        return 1
+    if args.encrypt_processes < 1:
+        stderr.write('Number of encrypt processes must be at least 1\n')
+        return 1
+    if args.prefetch_days < 1:
+        stderr.write('Number of prefetched days must be at least 1\n')
+        return 1
+    if args.since_last and not args.all:
+        stderr.write('--since-last only works with --all\n')
+        return 1
+    if args.since_last and args.spool:
+        stderr.write('--since-last needs the job service to acknowledge '
+                     'the jobs, it can not be combined with --spool\n')
+        return 1
+    if args.spool and args.skip_existing:
+        stderr.write('--skip-existing needs the job service, it can not be '
+                     'combined with --spool\n')
+        return 1
+    freqmodes = parse_freqmodes(args.freq_mode) if not args.upload else []
+    if freqmodes is None:
+        stderr.write('Invalid freq mode: {}\n'.format(args.freq_mode))
+        return 1
+    if len(freqmodes) > 1 and (args.jobs_file or args.skip):
+        stderr.write(
+            '--jobs-file and --skip only work with a single freq mode\n')
+        return 1
+    exclude = None
+    if args.exclude_file:
+        exclude = ScanIDSet.from_file(args.exclude_file)
+        print('Excluding {} scanids in {}'.format(
+            len(exclude), args.exclude_file))
+    batch_size = None
+    if args.adaptive_batch_size:
+        if not 0 < args.min_batch_size <= args.max_batch_size:
+            stderr.write(
+                'Batch sizes must satisfy 0 < min <= max\n')
+            return 1
+        batch_size = AdaptiveBatchSize(
+            args.min_batch_size, args.max_batch_size, args.target_latency)
+
     adder = AddQsmrJobs(
         args.PROJECT_NAME, args.ODIN_PROJECT, config['ODIN_API_ROOT'],
         config['ODIN_SECRET'], config['JOB_API_ROOT'],
-        config['JOB_API_USERNAME'], config['JOB_API_PASSWORD'])
-    skip = 0
+        config['JOB_API_USERNAME'], config['JOB_API_PASSWORD'],
+        concurrency=args.concurrency,
+        encrypt_processes=args.encrypt_processes, batch_size=batch_size,
+        post_timeout=args.post_timeout, skip_existing=args.skip_existing,
+        retries=args.retries, retry_backoff=args.retry_backoff,
+        compression=args.compress, compression_level=args.compress_level,
+        exclude=exclude)
+    if args.upload:
+        try:
+            spool = Spool(args.upload, args.PROJECT_NAME, create=False)
+        except SpoolError as err:
+            stderr.write('%s\n' % err)
+            return 1
+        return int(not adder.upload_spool(spool))
+    spool = None
+    if args.spool:
+        try:
+            spool = Spool(args.spool, args.PROJECT_NAME)
+        except SpoolError as err:
+            stderr.write('%s\n' % err)
+            return 1
+    skip = offset = 0
     if args.skip:
         skip = int(args.skip)
         print('Skipping the first {} scanids'.format(skip))
 
-    scanids = ScanIDs(config['ODIN_API_ROOT'])
-    if args.vds:
-        print('Adding all in vds dataset')
-        ids = scanids.generate_vds(freqmode)
-    elif args.all:
-        print('Adding all between {start} and {end}'.format(
-            start=args.start_day or ScanIDs.FIRST_DAY,
-            end=args.end_day or ScanIDs(
-                config['ODIN_API_ROOT']).get_latest_ecmf_day()))
-        ids = scanids.generate_all(
-            freqmode, start_day=args.start_day, end_day=args.end_day)
-    elif args.jobs_file:
-        print('Adding from file')
-        ids = scanids.generate_from_file(args.jobs_file)
+    cache = None
+    # Only the scan catalog of the odin api is cached
+    if (args.all or args.vds) and not args.no_cache:
+        cache = ResponseCache(
+            args.cache_dir, max_size=args.cache_size * 1024 ** 2,
+            refresh=args.refresh_cache)
+    scanids = ScanIDs(
+        config['ODIN_API_ROOT'], prefetch=args.prefetch_days, cache=cache)
+    try:
+        if args.vds:
+            print('Adding all in vds dataset')
+            sources = {
+                freqmode: scanids.generate_vds(freqmode)
+                for freqmode in freqmodes
+            }
+        elif args.all:
+            end_day = scanids.get_latest_ecmf_day()
+            if args.end_day:
+                end_day = min(args.end_day, end_day)
+            start_days = {}
+            if args.since_last:
+                watermarks = Watermarks(args.state_file)
+                for freqmode in freqmodes:
+                    last_day = watermarks.get(
+                        WATERMARK, watermark_key(args, freqmode))
+                    if last_day is not None:
+                        print('FM {}: added up to {}'.format(
+                            freqmode, last_day))
+                        start_days[freqmode] = shift_day(last_day, 1)
+            if start_days:
+                print('Adding all up to {}'.format(end_day))
+            else:
+                print('Adding all between {start} and {end}'.format(
+                    start=args.start_day or ScanIDs.FIRST_DAY, end=end_day))
+            if len(freqmodes) == 1:
+                sources = {freqmodes[0]: scanids.generate_all(
+                    freqmodes[0],
+                    start_day=start_days.get(freqmodes[0], args.start_day),
+                    end_day=end_day)}
+            else:
+                sources = scanids.generate_all_freqmodes(
+                    freqmodes, start_day=args.start_day, end_day=end_day,
+                    start_days=start_days)
+        elif args.jobs_file:
+            print('Adding from file')
+            sources = {freqmodes[0]: scanids.generate_from_file(
+                args.jobs_file, skip=skip)}
+            # The rows are skipped by the file reader
+            offset, skip = skip, 0
+    except OdinAPIError as err:
+        # The period info is walked once for all freqmodes up front
+        stderr.write('Failed: {}\n'.format(err))
+        return 1
+
+    errors = {}
+
+    def add_freqmode(freqmode, label=''):
+        """Add the freqmode and return True if all went well, errors are
+        reported and kept in errors so that the other freqmodes go on
+        """
+        try:
+            return add_source(freqmode, label)
+        except Exception as err:  # pylint: disable=broad-except
+            stderr.write('{}Failed: {}\n'.format(label, err))
+            errors[freqmode] = str(err) or type(err).__name__
+            return False
+
+    def add_source(freqmode, label):
+        ids = sources[freqmode]
+        journal = Journal(args.PROJECT_NAME, freqmode, args.journal_dir)
+        if args.resume:
+            print('{}Resuming from {}'.format(label, journal.path))
+            ids = journal.filter(ids)
+        if spool is not None:
+            ok = adder.spool_jobs(
+                ids, freqmode, spool, skip=skip, offset=offset,
+                encrypt_pool=encrypt_pool, label=label)
+        else:
+            ok = add_to_job_service(ids, freqmode, journal, label)
+        if args.resume:
+            print('{}Skipped {} scanids already in the journal'.format(
+                label, journal.nr_skipped))
+        if ok and args.since_last:
+            # All batches were acknowledged, the end day is exclusive
+            last_day = shift_day(end_day, -1)
+            key = watermark_key(args, freqmode)
+            if (watermarks.get(WATERMARK, key) or '') < last_day:
+                watermarks.set(WATERMARK, key, last_day)
+                print('{}Added up to {}'.format(label, last_day))
+        return ok
+
+    def add_to_job_service(ids, freqmode, journal, label):
+        dead_letters = None
+        if args.dead_letter:
+            dead_letters = DeadLetters(
+                args.dead_letter if not label
+                else '{}.{}'.format(args.dead_letter, freqmode))
+        return adder.add_jobs(
+            ids, freqmode, skip=skip, offset=offset, journal=journal,
+            dead_letters=dead_letters, encrypt_pool=encrypt_pool,
+            label=label)
+
+    encrypt_pool = None
+    if len(freqmodes) == 1:
+        return int(not add_freqmode(freqmodes[0]))
 
-    return int(not adder.add_jobs(ids, freqmode, skip=skip))
+    if args.encrypt_processes > 1:
+        encrypt_pool = ProcessPoolExecutor(args.encrypt_processes)
+    with encrypt_pool or nullcontext(), \
+            ThreadPoolExecutor(len(freqmodes)) as executor:
+        results = dict(zip(freqmodes, executor.map(
+            lambda freqmode: add_freqmode(
+                freqmode, label='FM {}: '.format(freqmode)),
+            freqmodes)))
+    print('Summary:')
+    for freqmode in freqmodes:
+        nr_added, status_codes = adder.totals.get(freqmode, (0, {}))
+        print('  FM {}: {} jobs {}{}'.format(
+            freqmode, nr_added, 'spooled' if spool is not None else 'added',
+            '' if results[freqmode] else ', FAILED' + (
+                ': ' + errors[freqmode] if freqmode in errors else '')))
+        for code in sorted(status_codes):
+            print('    Status code {}: {}'.format(code, status_codes[code]))
+    return int(not all(results.values()))
+
+
+def watermark_key(args, freqmode):
+    return '{}/{}/{}'.format(args.PROJECT_NAME, args.ODIN_PROJECT, freqmode)
+
+
+def shift_day(day, days):
+    """Return the day (yyyy-mm-dd) days days later"""
+    return (
+        datetime.strptime(day, '%Y-%m-%d') + timedelta(days=days)
+    ).strftime('%Y-%m-%d')
+
+
+def parse_freqmodes(freq_mode):
+    """Return sorted list of freqmodes from a comma separated list or 'all',
+    or None if invalid.
+    """
+    if freq_mode.strip().lower() == 'all':
+        return sorted(FREQMODE_TO_BACKEND)
+    try:
+        freqmodes = sorted({int(value) for value in freq_mode.split(',')})
+    except ValueError:
+        return None
+    return freqmodes or None
 
 
 class JobServiceError(Exception):
@@ -108,7 +447,12 @@ class AddQsmrJobs:
     JOB_TYPE = 'qsmr'
 
     def __init__(self, project, odin_project, odin_api_root, odin_secret,
-                 job_api_root, job_api_user, job_api_password):
+                 job_api_root, job_api_user, job_api_password,
+                 concurrency=1, encrypt_processes=1, batch_size=None,
+                 post_timeout=None, skip_existing=False, retries=RETRIES,
+                 retry_backoff=RETRY_BACKOFF, compression=None,
+                 compression_level=None, token_manager=None, exclude=None,
+                 existing_since=None):
         self.project = project
         self.odin_project = odin_project
         self.odin_api_root = odin_api_root
@@ -117,97 +461,551 @@ class AddQsmrJobs:
         self.job_api_password = job_api_password
         self.odin_secret = odin_secret
 
+        self.concurrency = concurrency
+        self.encrypt_processes = encrypt_processes
+        # None for NUMBER_OF_JOBS_TO_POST, else an AdaptiveBatchSize
+        self.batch_size = batch_size
+        self.post_timeout = post_timeout
+        self.skip_existing = skip_existing
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        # None, 'gzip' or 'zstd', reset to None if the job service answers
+        # 415 Unsupported Media Type
+        self.compression = compression
+        self.compression_level = compression_level
+        # ScanIDSet of scan ids that are not added, or None
+        self.exclude = exclude
+        # With skip_existing, only look for the jobs added since this date
+        # if it is not None
+        self.existing_since = existing_since
+
+        self._templates = {}
+        # freqmode -> (number of added jobs, {status code: number of posts})
+        self.totals = {}
+
         self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_maxsize=max(concurrency, DEFAULT_POOLSIZE))
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.token_manager = token_manager or TokenManager(
+            job_api_root, job_api_user, job_api_password,
+            session=self.session)
         self.token = None
+        # Unix time when self.token expires, None if unknown
+        self.token_expires = None
+        self._token_lock = threading.Lock()
+        # Limits the number of batch posts in flight for this instance
+        self._slots = threading.BoundedSemaphore(concurrency)
 
-    def make_job_data(self, scanid, freqmode):
-        return {
-            'id': '%s:%s' % (freqmode, scanid),
-            'type': self.JOB_TYPE,
-            'source_url': (self.odin_api_root +
-                           '/v4/l1_log/{freqmode}/{scanid}/'.format(
-                               scanid=scanid, freqmode=freqmode)),
-            'target_url': self.odin_api_root + '/v5/level2?d={}'.format(
-                encode_level2_target_parameter(
-                    scanid, freqmode, self.odin_project, self.odin_secret)),
-            'view_result_url': (
-                self.odin_api_root +
-                '/v5/level2/development/{project}/{freqmode}/{scanid}'.format(
-                    project=self.odin_project, freqmode=freqmode, scanid=scanid
-                ))
-        }
+    def job_template(self, freqmode):
+        """Return the JobTemplate for the jobs of the freqmode"""
+        template = self._templates.get(freqmode)
+        if template is None:
+            template = JobTemplate(
+                self.JOB_TYPE, self.odin_api_root, self.odin_project,
+                freqmode)
+            self._templates[freqmode] = template
+        return template
+
+    def make_job_data(self, scanid, freqmode, target=None):
+        """Return the job for the scan id, target is the encoded level2
+        target parameter and is encoded here if not given.
+        """
+        if target is None:
+            target = encode_level2_target_parameter(
+                scanid, freqmode, self.odin_project, self.odin_secret)
+        return self.job_template(freqmode).job(scanid, target)
 
     def _post_jobs(self, list_of_jobs):
-        return self.session.post(
-            self.job_api_root + '/v4/{}/jobs'.format(self.project),
-            headers={'Content-Type': "application/json"},
-            json=list_of_jobs, auth=(self.token, ''))
+        compression = self.compression
+        headers = {'Content-Type': "application/json"}
+        data = encode_jobs(list_of_jobs)
+        if compression is not None:
+            headers['Content-Encoding'] = compression
+            data = compress(data, compression, self.compression_level)
+        url = self.job_api_root + '/v4/{}/jobs'.format(self.project)
+        ratelimit.limit(url, jobs=len(list_of_jobs))
+        response = self.session.post(
+            url,
+            headers=headers, data=data, auth=(self.token, ''),
+            timeout=self.post_timeout)
+        if response.status_code == 415 and compression is not None:
+            if self.compression is not None:
+                print('The job service does not accept %s, posting '
+                      'uncompressed jobs' % compression)
+                self.compression = None
+            return self._post_jobs(list_of_jobs)
+        return response
+
+    def _post_batch(self, list_of_jobs):
+        """Post a batch of jobs and return the status code.
+
+        Connection errors, timeouts and RETRY_STATUS_CODES are retried
+        self.retries times with exponential backoff.
+        """
+        for attempt in range(self.retries + 1):
+            try:
+                response = self._post_authenticated(list_of_jobs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                if attempt == self.retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                reason = str(err)
+            else:
+                if (response.status_code not in RETRY_STATUS_CODES
+                        or attempt == self.retries):
+                    return response.status_code
+                delay = self._retry_delay(
+                    attempt, response.headers.get('Retry-After'))
+                reason = 'status code %s' % response.status_code
+            stderr.write('Add job failed: %s, retrying in %.1f s\n' % (
+                reason, delay))
+            time.sleep(delay)
+
+    def _post_authenticated(self, list_of_jobs):
+        """Post a batch of jobs with a token that is renewed shortly before
+        it expires, renew the token and retry once if it was rejected.
+        """
+        token = self.token
+        if (self.token_expires is not None
+                and self.token_expires - RENEW_MARGIN < time.time()):
+            self._renew_token(token, expired=False)
+            token = self.token
+        response = self._timed_post(list_of_jobs)
+        if response.status_code == 401:
+            self._renew_token(token)
+            response = self._timed_post(list_of_jobs)
+        return response
+
+    def _retry_delay(self, attempt, retry_after=None):
+        """Return seconds to wait before retry number attempt + 1"""
+        if retry_after is not None:
+            try:
+                delay = float(retry_after)
+            except ValueError:
+                try:
+                    delay = (
+                        parsedate_to_datetime(retry_after).timestamp()
+                        - time.time())
+                except (TypeError, ValueError):
+                    delay = None
+            if delay is not None:
+                return min(max(delay, 0), MAX_RETRY_DELAY)
+        return random.uniform(
+            0, min(self.retry_backoff * 2 ** attempt, MAX_RETRY_DELAY))
+
+    def _timed_post(self, list_of_jobs):
+        """Post the jobs and let the batch size adapt to how long it took"""
+        start = time.monotonic()
+        try:
+            response = self._post_jobs(list_of_jobs)
+        except requests.Timeout:
+            if self.batch_size is not None:
+                self.batch_size.observe(len(list_of_jobs), None, None)
+            raise
+        if self.batch_size is not None and response.status_code != 401:
+            self.batch_size.observe(
+                len(list_of_jobs), time.monotonic() - start,
+                response.status_code)
+        return response
 
     def get_token(self):
+        try:
+            self.token, self.token_expires = self.token_manager.get()
+        except TokenError as err:
+            raise JobServiceError(str(err))
+
+    def get_existing_scanids(self, freqmode):
+        """Return ScanIDSet of the scan ids of the jobs with this freqmode
+        that are already in the project, or that were added since
+        self.existing_since. The response is streamed and parsed one job at
+        a time.
+        """
+        url = self.job_api_root + '/v4/{}/jobs'.format(self.project)
+        kwargs = {}
+        if self.existing_since is not None:
+            kwargs['params'] = {
+                'start': self.existing_since.strftime('%Y-%m-%dT00:00:00')}
+        ratelimit.limit(url)
         r = self.session.get(
-            self.job_api_root + '/token',
-            auth=(self.job_api_user, self.job_api_password)
-        )
-        if r.status_code != 200:
-            raise JobServiceError('Get token returned %s' % r.status_code)
-        self.token = r.json()['token']
-
-    def add_jobs(self, scanids, freqmode, skip=0):
+            url, auth=(self.token, ''), stream=True, timeout=GET_JOBS_TIMEOUT,
+            **kwargs)
+        try:
+            if r.status_code != 200:
+                raise JobServiceError(
+                    'Get jobs returned %s' % r.status_code)
+            prefix = '%s:' % freqmode
+            jobs = iter_json_array(r.iter_content(CHUNK_SIZE), 'Jobs')
+            return ScanIDSet(
+                int(job['Id'][len(prefix):]) for job in jobs
+                if job['Id'].startswith(prefix))
+        finally:
+            r.close()
+
+    def _renew_token(self, old_token, expired=True):
+        """Fetch a new token unless another worker already replaced the old
+        one. If the job service rejected the old token it is expired and
+        must not be reused from the cache.
+        """
+        with self._token_lock:
+            if self.token == old_token:
+                if expired:
+                    print('Fetching new token')
+                    self.token_manager.invalidate(old_token)
+                self.get_token()
+
+    def add_jobs(self, scanids, freqmode, skip=0, journal=None,
+                 dead_letters=None, encrypt_pool=None, label='', offset=0):
+        """Add jobs for the scan ids, NUMBER_OF_JOBS_TO_POST at a time or
+        as many as self.batch_size currently allows.
+
+        The scan ids are consumed lazily, each batch is built right before
+        it is posted. At most self.concurrency batches are in flight at the
+        same time. Batches that the job service accepts are recorded in
+        the journal if given. If self.skip_existing, jobs that are already
+        in the project are not added again, nor are the scan ids in
+        self.exclude.
+
+        A batch fails if it still raises or gets a status code other than
+        2xx after all retries, its jobs are not counted as added. Without
+        dead_letters the first failed batch stops the submission. With
+        dead_letters the scan ids of failed batches are written there and
+        the remaining batches are posted.
+
+        Several freqmodes can be added concurrently from different threads,
+        they share the token, the connection pool and the limit on batches
+        in flight. The number of added jobs and the status codes of the
+        posts are kept in self.totals[freqmode]. Status lines start with
+        label.
+
+        offset is the number of scan ids that the source of scanids has
+        already skipped, e.g. by seeking in a binary jobs file. Like skip it
+        counts in the progress.
+        """
         self.get_token()
+        scanids = islice(scanids, skip, None)
+        skip += offset
+        existing = None
+        if self.skip_existing or self.exclude is not None:
+            excluded = self.exclude or ScanIDSet()
+            if self.skip_existing:
+                found = self.get_existing_scanids(freqmode)
+                print('%sFound %d existing jobs for freqmode %s' % (
+                    label, len(found), freqmode))
+                excluded = excluded | found
+            existing = _ExistingFilter(excluded)
+            scanids = existing.filter(scanids)
 
-        def print_status(nr_processed, status_codes):
-            print('%d jobs added (skipped %d)' % (nr_processed, skip))
+        def print_status(nr_processed, status_codes, size=None):
+            if self.batch_size is None or size is None:
+                print('%s%d jobs added (skipped %d)' % (
+                    label, nr_processed, skip))
+            else:
+                print((
+                    '%s%d jobs added (skipped %d, batch size %d, next %d)'
+                    '') % (label, nr_processed, skip, size,
+                           self.batch_size.size))
             for k in sorted(status_codes.keys()):
-                print('  Status code %s: %d' % (k, len(status_codes[k])))
+                print('%s  Status code %s: %d' % (
+                    label, k, len(status_codes[k])))
 
         status_codes = defaultdict(list)
-        list_of_jobs = self.filter_jobs(
-            scanids, freqmode, skip)
-        # split the post into several posts if list of jobs is long
-        for n_post in range(len(list_of_jobs) // NUMBER_OF_JOBS_TO_POST + 1):
-            try:
-                response = self._post_jobs(
-                    list_of_jobs[
-                        n_post * NUMBER_OF_JOBS_TO_POST:
-                        (n_post + 1) * NUMBER_OF_JOBS_TO_POST])
-                status_code = response.status_code
-                if status_code == 401:
-                    print('Fetching new token')
-                    self.get_token()
-                    response = self._post_jobs(
-                        list_of_jobs[
-                            n_post * NUMBER_OF_JOBS_TO_POST:
-                            (n_post + 1) * NUMBER_OF_JOBS_TO_POST])
-                    status_code = response.status_code
+        progress = _Progress(skip)
+        pending = {}
+        failed = []
+
+        def collect(block):
+            if block and pending:
+                wait(pending)
+            done = sorted(
+                (f for f in pending if f.done()), key=lambda f: pending[f])
+            for future in done:
+                n_post, batch = pending.pop(future)
+                size = len(batch)
+                try:
+                    status_code = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    stderr.write('Add job failed: %s\n' % err)
+                    if dead_letters is None:
+                        failed.append(n_post)
+                    else:
+                        dead_letters.record(batch)
+                    continue
                 status_codes[status_code].append(n_post)
-            except Exception as err:  # pylint: disable=broad-except
-                stderr.write('Add job failed: %s\n' % err)
-                print_status(n_post, status_codes)
-                print(('Exiting, you can try add_jobs.py again with --skip=%s'
-                       '') % (n_post * NUMBER_OF_JOBS_TO_POST))
-                return False
-            nr_of_jobs_added = min(
-                len(list_of_jobs), (n_post + 1) * NUMBER_OF_JOBS_TO_POST)
-            print_status(nr_of_jobs_added, status_codes)
+                if 200 <= status_code < 300:
+                    if journal is not None:
+                        journal.record(batch)
+                    progress.acknowledge(n_post, size)
+                else:
+                    # Rejected after all retries, the jobs were not added
+                    stderr.write('Add job failed: status code %s\n' % (
+                        status_code))
+                    if dead_letters is None:
+                        failed.append(n_post)
+                    else:
+                        dead_letters.record(batch)
+                self.totals[freqmode] = (progress.nr_added, {
+                    code: len(posts) for code, posts in status_codes.items()
+                })
+                print_status(progress.nr_added, status_codes, size)
+
+        with self._encrypt_pool(encrypt_pool) as pool, \
+                ThreadPoolExecutor(self.concurrency) as executor:
+            batches = self.generate_batches(
+                scanids, freqmode, 0,
+                self.batch_size or NUMBER_OF_JOBS_TO_POST, pool)
+            try:
+                for n_post in count():
+                    # Wait for a free slot before building the next batch,
+                    # so that it is built from the latest batch size
+                    self._slots.acquire()
+                    try:
+                        collect(block=False)
+                        batch, list_of_jobs = (
+                            (None, None) if failed
+                            else next(batches, (None, None)))
+                    except BaseException:
+                        # E.g. the scan id source failed, the slot is
+                        # shared with the other freqmodes
+                        self._slots.release()
+                        raise
+                    if batch is None:
+                        self._slots.release()
+                        break
+                    future = executor.submit(self._post_batch, list_of_jobs)
+                    pending[future] = (n_post, batch)
+                    future.add_done_callback(
+                        lambda _: self._slots.release())
+            finally:
+                # Journal the batches in flight also if the source failed
+                collect(block=True)
+        if existing is not None:
+            print('%s%d jobs already in the project%s were not added' % (
+                label, existing.nr_skipped,
+                ' or excluded' if self.exclude is not None else ''))
+        if dead_letters is not None and dead_letters.nr_batches:
+            print_status(progress.nr_added, status_codes)
+            print(('%s%d batches failed, you can add them later with '
+                   '--freq-mode=%s --jobs-file=%s') % (
+                       label, dead_letters.nr_batches, freqmode,
+                       dead_letters.path))
+            return False
+        if failed:
+            print_status(progress.nr_added, status_codes)
+            print(('%sExiting, you can try add_jobs.py again with --skip=%s'
+                   '') % (label, progress.offset))
+            if journal is not None:
+                print('%sor with --resume to skip the batches in %s' % (
+                    label, journal.path))
+            return False
+        return True
+
+    def _encrypt_pool(self, encrypt_pool=None):
+        """Return context manager of the executor that encrypts the target
+        parameters, encrypt_pool if given
+        """
+        if encrypt_pool is not None:
+            return nullcontext(encrypt_pool)
+        if self.encrypt_processes > 1:
+            return ProcessPoolExecutor(self.encrypt_processes)
+        return nullcontext()
+
+    def spool_jobs(self, scanids, freqmode, spool, skip=0, encrypt_pool=None,
+                   label='', offset=0):
+        """Write the jobs for the scan ids to the spool in batches of
+        NUMBER_OF_JOBS_TO_POST, or self.batch_size, instead of posting them.
+        The number of spooled jobs is kept in self.totals[freqmode]. The
+        scan ids in self.exclude are not spooled.
+        """
+        nr_spooled = 0
+        scanids = islice(scanids, skip, None)
+        excluded = None
+        if self.exclude is not None:
+            excluded = _ExistingFilter(self.exclude)
+            scanids = excluded.filter(scanids)
+        with self._encrypt_pool(encrypt_pool) as pool:
+            batches = self.generate_batches(
+                scanids, freqmode, 0,
+                self.batch_size or NUMBER_OF_JOBS_TO_POST, pool)
+            for _, list_of_jobs in batches:
+                spool.write(freqmode, list_of_jobs)
+                nr_spooled += len(list_of_jobs)
+                self.totals[freqmode] = (nr_spooled, {})
+                print('%s%d jobs spooled (skipped %d)' % (
+                    label, nr_spooled, skip + offset))
+        if excluded is not None:
+            print('%s%d excluded jobs were not spooled' % (
+                label, excluded.nr_skipped))
         return True
 
+    def upload_spool(self, spool):
+        """Post the spooled batches that are not uploaded yet,
+        self.concurrency batches at a time.
+
+        Batches that the job service accepts are marked as uploaded in the
+        spool manifest, the others are left to be retried by another
+        upload.
+        """
+        self.get_token()
+        entries = spool.pending()
+        print('Uploading %d of %d batches in %s' % (
+            len(entries), len(spool.batches), spool.directory))
+        status_codes = defaultdict(int)
+        nr_added = 0
+        ok = True
+        with ThreadPoolExecutor(self.concurrency) as executor:
+            futures = {
+                executor.submit(self._post_spooled, spool, entry): entry
+                for entry in entries
+            }
+            for future in as_completed(futures):
+                entry = futures[future]
+                try:
+                    status_code = future.result()
+                except Exception as err:  # pylint: disable=broad-except
+                    stderr.write('Add job failed: %s\n' % err)
+                    ok = False
+                    continue
+                status_codes[status_code] += 1
+                if 200 <= status_code < 300:
+                    spool.mark_uploaded(entry)
+                    nr_added += entry['count']
+                else:
+                    ok = False
+                print('%d jobs added' % nr_added)
+        for code in sorted(status_codes):
+            print('  Status code %s: %d' % (code, status_codes[code]))
+        if not ok:
+            print('Some batches were not added, you can try again with '
+                  '--upload=%s' % spool.directory)
+        return ok
+
+    def _post_spooled(self, spool, entry):
+        return self._post_batch(spool.read(entry))
+
+    def generate_batches(self, scanids, freqmode, skip, batch_size,
+                         encrypt_pool=None):
+        """Generate (scanids, JobBatch) for batches of at most batch_size
+        scan ids, skipping the first skip scan ids. batch_size is an int or
+        an AdaptiveBatchSize.
+
+        The target parameters of each batch are encoded together, by the
+        encrypt_pool executor if given.
+        """
+        for batch in batched(islice(scanids, skip, None), batch_size):
+            targets = encode_level2_target_parameters(
+                ((scanid, freqmode) for scanid in batch),
+                self.odin_project, self.odin_secret, executor=encrypt_pool)
+            yield batch, JobBatch(
+                self.job_template(freqmode), batch, targets)
+
     def filter_jobs(self, scanids, freqmode, skip):
-        list_of_jobs = []
-        for i, scanid in enumerate(scanids):
-            if i < skip:
+        """Generate jobs for the scan ids, skipping the first skip ids"""
+        for scanid in islice(scanids, skip, None):
+            yield self.make_job_data(scanid, freqmode)
+
+
+class _Progress:
+    """Keep track of acknowledged batches.
+
+    Batches may be acknowledged out of order, offset is the position in the
+    scan id sequence up to which all batches have been acknowledged.
+    """
+    def __init__(self, offset):
+        self.offset = offset
+        self.nr_added = 0
+        self._next_post = 0
+        self._acknowledged = {}
+
+    def acknowledge(self, n_post, size):
+        self.nr_added += size
+        self._acknowledged[n_post] = size
+        while self._next_post in self._acknowledged:
+            self.offset += self._acknowledged.pop(self._next_post)
+            self._next_post += 1
+
+
+class _ExistingFilter:
+    """Drop scan ids that are in a ScanIDSet of existing scan ids"""
+    def __init__(self, scanids):
+        self.scanids = scanids
+        self.nr_skipped = 0
+
+    def filter(self, scanids):
+        for scanid in scanids:
+            if int(scanid) in self.scanids:
+                self.nr_skipped += 1
                 continue
-            list_of_jobs.append(self.make_job_data(scanid, freqmode))
-        return list_of_jobs
+            yield scanid
+
+
+class AdaptiveBatchSize:
+    """Number of jobs per post that adapts to the observed post latency.
+
+    After each post the size moves towards the number of jobs that is
+    expected to be posted in target_latency seconds, at most doubling at a
+    time. Timeouts and server errors halve the size.
+    """
+    def __init__(self, min_size, max_size, target_latency,
+                 size=NUMBER_OF_JOBS_TO_POST):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.target_latency = target_latency
+        self.size = self._clamp(size)
+        self._lock = threading.Lock()
+
+    def __int__(self):
+        return self.size
+
+    def _clamp(self, size):
+        return max(self.min_size, min(self.max_size, int(size)))
+
+    def observe(self, size, latency, status_code):
+        """Update the size from a post of size jobs that took latency
+        seconds, latency and status_code are None for a timeout.
+        """
+        with self._lock:
+            if status_code is None or status_code >= 500:
+                self.size = self._clamp(self.size // 2)
+            elif latency > 0:
+                wanted = size * self.target_latency / latency
+                self.size = self._clamp(
+                    min(max(wanted, self.size / 2), self.size * 2))
+
+
+def batched(iterable, size):
+    """Generate lists of at most size items from iterable, size is read
+    with int() before each batch so that it can change between batches.
+    """
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, int(size)))
+        if not batch:
+            return
+        yield batch
+
+
+def compress(data, compression, level=None):
+    """Return data compressed with 'gzip' or 'zstd'"""
+    if level is None:
+        level = COMPRESSION_LEVELS[compression]
+    if compression == 'gzip':
+        return gzip.compress(data, level)
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(data)
+    raise ValueError('Unknown compression: %s' % compression)
 
 
 def encrypt(msg, secret):
-    cipher = AES.new(base64.b64decode(secret.encode()), AES.MODE_EAX)
-    ciphertext, tag = cipher.encrypt_and_digest(msg.encode())
-    bytes = BytesIO()
-    for x in (cipher.nonce, tag, ciphertext):
-        bytes.write(x)
-    bytes.seek(0)
-    return base64.urlsafe_b64encode(bytes.read()).decode('utf8')
+    return _encrypt(msg.encode(), base64.b64decode(secret.encode()))
+
+
+def _encrypt(data, key):
+    cipher = AES.new(key, AES.MODE_EAX)
+    ciphertext, tag = cipher.encrypt_and_digest(data)
+    return base64.urlsafe_b64encode(
+        cipher.nonce + tag + ciphertext).decode('utf8')
 
 
 def encode_level2_target_parameter(scanid, freqmode, project, secret):
@@ -216,3 +1014,37 @@ def encode_level2_target_parameter(scanid, freqmode, project, secret):
     """
     data = {'ScanID': scanid, 'FreqMode': freqmode, 'Project': project}
     return encrypt(json.dumps(data), secret)
+
+
+def encode_level2_target_parameters(targets, project, secret, executor=None,
+                                    chunk_size=ENCODE_CHUNK_SIZE):
+    """Return list of encrypted level2 post url parameters, one for each
+    (scanid, freqmode) in targets.
+
+    The secret is only decoded once. If an executor (e.g. a
+    ProcessPoolExecutor) is given, targets are split in chunks of chunk_size
+    that are encoded by the executor.
+    """
+    key = base64.b64decode(secret.encode())
+    targets = list(targets)
+    if executor is None or len(targets) <= chunk_size:
+        return _encode_targets(key, project, targets)
+    chunks = [
+        targets[start:start + chunk_size]
+        for start in range(0, len(targets), chunk_size)
+    ]
+    return [
+        token
+        for tokens in executor.map(
+            _encode_targets, repeat(key), repeat(project), chunks)
+        for token in tokens
+    ]
+
+
+def _encode_targets(key, project, targets):
+    return [
+        _encrypt(json.dumps({
+            'ScanID': scanid, 'FreqMode': freqmode, 'Project': project
+        }).encode(), key)
+        for scanid, freqmode in targets
+    ]
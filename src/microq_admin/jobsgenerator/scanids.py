@@ -1,6 +1,28 @@
+import ast
+import gzip
+import json
+import lzma
+import mmap
+import random
+import struct
+import sys
+import threading
+import time
 from datetime import timedelta, datetime
+from functools import partial
+from itertools import islice
+from sys import stderr
 
 import requests
+from requests.adapters import DEFAULT_POOLSIZE, HTTPAdapter
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+from .jsonstream import CHUNK_SIZE, iter_json_array
+from .. import ratelimit
+from ..utils import ordered_map
 
 FREQMODE_TO_BACKEND = {
     1: "AC2",
@@ -21,6 +43,171 @@ FREQMODE_TO_BACKEND = {
     119: "AC2",
     121: "AC2",
 }
+# Number of day logs fetched concurrently ahead of the scan ids being
+# generated
+PREFETCH_DAYS = 8
+# Seconds to wait for a connection to and an answer from the odin api
+CONNECT_TIMEOUT = 10
+READ_TIMEOUT = 120
+# Retries of failed requests to the odin api, with exponential backoff
+# from RETRY_BACKOFF seconds
+RETRIES = 3
+RETRY_BACKOFF = 1
+MAX_RETRY_DELAY = 60
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+# Days per period info request, the length adapts to how long the
+# requests take and how large the responses are
+PERIOD_DAYS = 365
+MIN_PERIOD_DAYS = 30
+MAX_PERIOD_DAYS = 4 * 365
+PERIOD_TARGET_LATENCY = 5
+PERIOD_TARGET_BYTES = 4 * 1024 * 1024
+# With a cache the period info is cached in windows of this many days,
+# aligned to the first day of the mission, so that the cache entries do
+# not depend on the adaptive length
+CACHED_PERIOD_DAYS = MIN_PERIOD_DAYS
+
+
+# Suffixes of the binary scan id files
+BINARY_SUFFIXES = ('.u64', '.npy')
+_NPY_MAGIC = b'\x93NUMPY'
+
+
+def _open_compressed(filename):
+    """Return binary file object of the decompressed content of filename,
+    compression is given by the suffix
+    """
+    if filename.endswith('.gz'):
+        return gzip.open(filename)
+    if filename.endswith('.xz'):
+        return lzma.open(filename)
+    if filename.endswith('.zst'):
+        if zstandard is None:
+            raise ValueError('Install zstandard to read %s' % filename)
+        return zstandard.ZstdDecompressor().stream_reader(
+            open(filename, 'rb'), closefd=True)
+    return open(filename, 'rb')
+
+
+def _generate_from_text(filename):
+    """Generate the scan ids in a text file with one scan id per row,
+    parsed a block at a time
+    """
+    with _open_compressed(filename) as inp:
+        rest = b''
+        for block in iter(partial(inp.read, CHUNK_SIZE), b''):
+            block = rest + block
+            scanids = block.split()
+            # The last id may continue in the next block
+            rest = scanids.pop() if not block[-1:].isspace() else b''
+            for scanid in map(int, scanids):
+                yield scanid
+        if rest:
+            yield int(rest)
+
+
+def _npy_data(mapped, filename):
+    """Return (offset, length) of the data in a mapped .npy file, which
+    must hold a one dimensional little-endian 64 bit integer array
+    """
+    if mapped[:6] != _NPY_MAGIC:
+        raise ValueError('%s is not a .npy file' % filename)
+    if mapped[6] == 1:
+        start = 10
+        (header_length,) = struct.unpack('<H', mapped[8:start])
+    else:
+        start = 12
+        (header_length,) = struct.unpack('<I', mapped[8:start])
+    header = ast.literal_eval(
+        mapped[start:start + header_length].decode('latin1'))
+    if (header['descr'] not in ('<u8', '<i8') or header['fortran_order']
+            or len(header['shape']) != 1):
+        raise ValueError(
+            '%s must hold a one dimensional little-endian uint64 array' % (
+                filename))
+    return start + header_length, header['shape'][0]
+
+
+def _generate_from_binary(filename, skip):
+    """Generate the scan ids in a memory mapped binary file, without
+    copying it
+    """
+    with open(filename, 'rb') as inp:
+        if not inp.seek(0, 2):
+            return
+        with mmap.mmap(inp.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if filename.endswith('.npy'):
+                start, length = _npy_data(mapped, filename)
+            else:
+                start, length = 0, len(mapped) // 8
+            view = memoryview(mapped)[start + 8 * min(skip, length):
+                                      start + 8 * length]
+            try:
+                if sys.byteorder == 'little':
+                    scanids = view.cast('Q')
+                    try:
+                        for scanid in scanids:
+                            yield scanid
+                    finally:
+                        scanids.release()
+                else:
+                    for (scanid,) in struct.iter_unpack('<Q', view):
+                        yield scanid
+            finally:
+                view.release()
+
+
+class OdinAPIError(Exception):
+    pass
+
+
+class PeriodLength:
+    """Number of days per period info request that adapts to the
+    observed requests.
+
+    After each request the length moves towards the number of days that is
+    expected to take target_latency seconds and give at most target_bytes
+    of response, at most doubling or halving at a time.
+    """
+    def __init__(self, days=PERIOD_DAYS, min_days=MIN_PERIOD_DAYS,
+                 max_days=MAX_PERIOD_DAYS,
+                 target_latency=PERIOD_TARGET_LATENCY,
+                 target_bytes=PERIOD_TARGET_BYTES):
+        self.min_days = min_days
+        self.max_days = max_days
+        self.target_latency = target_latency
+        self.target_bytes = target_bytes
+        self.days = self._clamp(days)
+        self._lock = threading.Lock()
+
+    def __int__(self):
+        return self.days
+
+    def _clamp(self, days):
+        return max(self.min_days, min(self.max_days, int(days)))
+
+    def observe(self, days, latency, size):
+        """Update the length from a request for days days that took latency
+        seconds and gave size bytes.
+        """
+        factors = []
+        if latency > 0:
+            factors.append(self.target_latency / latency)
+        if size > 0:
+            factors.append(self.target_bytes / size)
+        if not factors:
+            return
+        with self._lock:
+            wanted = days * min(factors)
+            self.days = self._clamp(
+                min(max(wanted, self.days / 2), self.days * 2))
+
+
+def _tee(chunks, out):
+    """Generate the chunks while writing them to out"""
+    for chunk in chunks:
+        out.write(chunk)
+        yield chunk
 
 
 class ScanIDs:
@@ -29,28 +216,135 @@ class ScanIDs:
     FIRST_DAY = '2001-08-04'
     ONE_DAY = timedelta(days=1)
 
-    def __init__(self, odin_api_root):
+    def __init__(self, odin_api_root, prefetch=PREFETCH_DAYS, cache=None,
+                 session=None, pool_size=None,
+                 timeout=(CONNECT_TIMEOUT, READ_TIMEOUT), retries=RETRIES,
+                 retry_backoff=RETRY_BACKOFF):
+        """The requests go through session, or a new session with a
+        connection pool of pool_size connections, by default enough for
+        the prefetched period info and day logs. At most pool_size
+        requests run at once, shared by all generators of the object, e.g.
+        those of generate_all_freqmodes. timeout is (connect, read)
+        seconds.
+        """
         self.odin_api_root = odin_api_root
+        self.prefetch = prefetch
+        # ResponseCache for the scan catalog responses, or None
+        self.cache = cache
+        self.timeout = timeout
+        self.retries = retries
+        self.retry_backoff = retry_backoff
+        self.period_length = PeriodLength()
+        pool_size = pool_size or max(2 * prefetch, DEFAULT_POOLSIZE)
+        self._requests = threading.BoundedSemaphore(pool_size)
+        if session is None:
+            session = requests.Session()
+            adapter = HTTPAdapter(pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+        self.session = session
+        self._latest_ecmf_day = None
+
+    def _get(self, url, **kwargs):
+        """Return the response for url.
+
+        Connection errors, timeouts and RETRY_STATUS_CODES are retried
+        self.retries times with exponential backoff. OdinAPIError is raised
+        if there still is no response with status code 200. Streamed
+        responses must be read while holding self._requests.
+        """
+        for attempt in range(self.retries + 1):
+            ratelimit.limit(url)
+            try:
+                if kwargs.get('stream'):
+                    resp = self.session.get(
+                        url, timeout=self.timeout, **kwargs)
+                else:
+                    with self._requests:
+                        resp = self.session.get(
+                            url, timeout=self.timeout, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as err:
+                reason = str(err)
+            else:
+                if resp.status_code == 200:
+                    return resp
+                resp.close()
+                reason = 'status code %s' % resp.status_code
+                if resp.status_code not in RETRY_STATUS_CODES:
+                    break
+            if attempt == self.retries:
+                break
+            delay = random.uniform(
+                0, min(self.retry_backoff * 2 ** attempt, MAX_RETRY_DELAY))
+            stderr.write('Get %s failed: %s, retrying in %.1f s\n' % (
+                url, reason, delay))
+            time.sleep(delay)
+        raise OdinAPIError('Get %s failed: %s' % (url, reason))
+
+    def _get_json(self, url, immutable=False):
+        """Return the JSON response for url, from the cache if possible"""
+        if self.cache is not None:
+            data = self.cache.get(url)
+            if data is not None:
+                return data
+        resp = self._get(url)
+        data = resp.json()
+        if self.cache is not None:
+            self.cache.put(url, resp.content, immutable)
+        return data
 
     @staticmethod
-    def generate_from_file(filename):
-        """Generate scan ids from a file"""
-        with open(filename) as inp:
-            for line in inp:
-                line = line.strip()
-                if line:
-                    yield int(line)
+    def generate_from_file(filename, skip=0):
+        """Generate scan ids from a file, skipping the first skip ids.
+
+        Text files have one scan id per row and may be compressed (.gz,
+        .xz or .zst). Binary files are little-endian uint64 arrays, either
+        raw (.u64) or in numpy format (.npy), they are memory mapped and
+        skip is a seek.
+        """
+        if filename.endswith(BINARY_SUFFIXES):
+            return _generate_from_binary(filename, skip)
+        return islice(_generate_from_text(filename), skip, None)
 
     def generate_vds(self, freqmode):
-        """Generate all scan ids in the vds dataset"""
+        """Generate all scan ids in the vds dataset.
+
+        The response is streamed and parsed one scan at a time, so memory
+        use does not grow with the size of the dataset.
+        """
         backend = FREQMODE_TO_BACKEND[freqmode]
-        resp = requests.get(
-            self.odin_api_root + (
-                '/v4/vds/{backend}/{freqmode}/allscans'.format(
-                    backend=backend, freqmode=freqmode)))
-        for info in resp.json()['VDS']:
+        url = self.odin_api_root + (
+            '/v4/vds/{backend}/{freqmode}/allscans'.format(
+                backend=backend, freqmode=freqmode))
+        for info in self._stream_json_array(url, 'VDS'):
             yield info['Info']['ScanID']
 
+    def _stream_json_array(self, url, key):
+        """Generate the items of the array under key in the JSON response
+        for url, from the cache if possible. The response is streamed into
+        the cache while it is parsed.
+        """
+        inp = self.cache.open(url) if self.cache is not None else None
+        if inp is not None:
+            with inp:
+                for item in iter_json_array(
+                        iter(partial(inp.read, CHUNK_SIZE), b''), key):
+                    yield item
+            return
+        with self._requests, self._get(url, stream=True) as resp:
+            chunks = resp.iter_content(CHUNK_SIZE)
+            if self.cache is None:
+                for item in iter_json_array(chunks, key):
+                    yield item
+                return
+            with self.cache.writer(url) as out:
+                chunks = _tee(chunks, out)
+                for item in iter_json_array(chunks, key):
+                    yield item
+                # Cache the rest of the document after the array
+                for _ in chunks:
+                    pass
+
     def generate_all(self, freqmode, start_day=None, end_day=None):
         """Generate all scan ids for a freqmode between two dates,
         but only ids that have ecmf data available.
@@ -63,6 +357,41 @@ class ScanIDs:
         Yields:
           scanid (int): The scan id.
         """
+        start_day, end_day = self._get_period(start_day, end_day)
+        days = self.generate_days_with_scans(start_day, end_day, freqmode)
+        for scanid in self._generate_from_days(days):
+            yield scanid
+
+    def generate_all_freqmodes(self, freqmodes, start_day=None,
+                               end_day=None, start_days=None):
+        """Like generate_all for several freqmodes, but with one walk over
+        the period info for all of them. start_days is an optional dict
+        of freqmode -> start day that overrides start_day.
+
+        Returns:
+          dict: freqmode -> generator of scan ids.
+        """
+        start_days = {
+            freqmode: (start_days or {}).get(freqmode) or start_day
+            or self.FIRST_DAY
+            for freqmode in freqmodes
+        }
+        start_day, end_day = self._get_period(
+            min(start_days.values()), end_day)
+        days = {freqmode: [] for freqmode in freqmodes}
+        for day in self.generate_days_with_scans(
+                start_day, end_day, freqmodes):
+            if day[0] >= start_days[day[3]]:
+                days[day[3]].append(day[:3])
+        return {
+            freqmode: self._generate_from_days(days[freqmode])
+            for freqmode in freqmodes
+        }
+
+    def _get_period(self, start_day, end_day):
+        """Return (start, end) datetimes, end is at most the latest day
+        with ecmf data available.
+        """
         start_day = datetime.strptime(
             start_day or self.FIRST_DAY, '%Y-%m-%d')
         latest_available = self.get_latest_ecmf_day()
@@ -70,52 +399,189 @@ class ScanIDs:
             end_day = latest_available
         else:
             end_day = min(end_day, latest_available)
-        end_day = datetime.strptime(end_day, '%Y-%m-%d')
-        days = self.generate_days_with_scans(start_day, end_day, freqmode)
-        for _, url, _ in days:
-            for scanid in self.get_scan_ids_from_log(url):
+        return start_day, datetime.strptime(end_day, '%Y-%m-%d')
+
+    def _generate_from_days(self, days):
+        """Generate the scan ids in the logs of the days, in the order of
+        the days. The days are older than the latest ecmf data, so their
+        logs are cached as immutable.
+
+        Up to self.prefetch day logs are fetched concurrently ahead of the
+        day whose scan ids are being generated, so at most that many day
+        logs are held in memory.
+        """
+        logs = ordered_map(
+            partial(self.get_scan_ids_from_log, immutable=True),
+            (url for _, url, _ in days), self.prefetch)
+        for scanids in logs:
+            for scanid in scanids:
                 yield scanid
 
-    @staticmethod
-    def get_scan_ids_from_log(url):
+    def get_scan_ids_from_log(self, url, immutable=False):
         """Return list of scan ids found in url"""
-        resp = requests.get(url)
-        return [scan['ScanID'] for scan in resp.json()['Data']]
+        return [
+            scan['ScanID']
+            for scan in self._get_json(url, immutable=immutable)['Data']
+        ]
 
     def get_latest_ecmf_day(self):
-        resp = requests.get(
-            self.odin_api_root + '/v5/config_data/latest_ecmf_file')
-        return resp.json()['Date']
+        """Return the latest day with ecmf data (%Y-%m-%d), only fetched
+        once for the lifetime of the object
+        """
+        if self._latest_ecmf_day is None:
+            resp = self._get(
+                self.odin_api_root + '/v5/config_data/latest_ecmf_file')
+            self._latest_ecmf_day = resp.json()['Date']
+        return self._latest_ecmf_day
 
     def generate_days_with_scans(self, start_day, end_day, freqmode,
-                                 step_size=365):
+                                 step_size=None):
         """Generate all days between two dates with scans in the specified
         freqmode.
 
+        The period is split into windows that are fetched concurrently, up
+        to self.prefetch at a time, and generated in date order.
+
         Args:
           start_day (datetime): Start from this day (inclusive).
           end_day (datetime): End with this day (exclusive).
+          freqmode (int or collection of ints): The freqmode(s).
+          step_size (int): Days per window, by default self.period_length
+            which adapts to the requests.
 
         Yields:
-          str: Day (%Y-%m-%d).
+          tuple: (day (%Y-%m-%d), log url, number of scans), followed by the
+            freqmode if several freqmodes were asked for.
         """
-        while start_day < end_day:
-            resp = requests.get(
-                self.odin_api_root + (
-                    '/v5/period_info/{year}/{month:0>2}/{day:0>2}/'
-                    '?length={nrdays}').format(
-                        year=start_day.year, month=start_day.month,
-                        day=start_day.day, nrdays=step_size))
-            assert resp.status_code == 200
-            data = resp.json()
+        several = not isinstance(freqmode, int)
+        freqmodes = set(freqmode) if several else {freqmode}
+        length = self.period_length if step_size is None else step_size
+
+        def windows():
+            # The length is read as each window is submitted
+            window_start = start_day
+            if self.cache is not None:
+                window_start = self._align_period(start_day)
+            while window_start < end_day:
+                nrdays = int(length)
+                if self.cache is not None:
+                    nrdays = CACHED_PERIOD_DAYS * max(
+                        1, round(nrdays / CACHED_PERIOD_DAYS))
+                window_end = min(
+                    window_start + timedelta(days=nrdays), end_day)
+                yield window_start, window_end
+                window_start = window_end
+
+        first, end = start_day.strftime('%Y-%m-%d'), end_day.strftime(
+            '%Y-%m-%d')
+        periods = ordered_map(
+            lambda window: self._get_period_info(*window, end_day),
+            windows(), self.prefetch)
+        for period in periods:
             days = [
                 (day['Date'], day['URL'], day['NumScan'])
-                for day in data['Data']
-                if day['FreqMode'] == freqmode and
-                datetime.strptime(day['Date'], '%Y-%m-%d')
-                < end_day
+                + ((day['FreqMode'],) if several else ())
+                for day in period
+                if day['FreqMode'] in freqmodes and first <= day['Date'] < end
             ]
             for day in sorted(days):
                 yield day
-            start_day = datetime.strptime(
+
+    def _align_period(self, day):
+        """Return the start of the cached period window that day is in"""
+        first_day = datetime.strptime(self.FIRST_DAY, '%Y-%m-%d')
+        return first_day + timedelta(days=(
+            (day - first_day).days // CACHED_PERIOD_DAYS
+            * CACHED_PERIOD_DAYS))
+
+    def _period_info_url(self, start_day, nrdays):
+        return self.odin_api_root + (
+            '/v5/period_info/{year}/{month:0>2}/{day:0>2}/'
+            '?length={nrdays}').format(
+                year=start_day.year, month=start_day.month,
+                day=start_day.day, nrdays=nrdays)
+
+    def _get_period_info(self, start_day, end_day, last_day):
+        """Return list of the period info of the days from start_day
+        (inclusive) to end_day (exclusive).
+
+        With a cache, start_day is aligned with _align_period and the
+        period info is looked up per window of CACHED_PERIOD_DAYS days,
+        ending at most at last_day. The windows that are not cached are
+        fetched together and cached one by one.
+        """
+        if self.cache is None:
+            return self._fetch_period_info(start_day, end_day)[0]
+        days = []
+        missing_start = None
+        window_start = start_day
+        while window_start < end_day:
+            window_end = min(
+                window_start + timedelta(days=CACHED_PERIOD_DAYS), last_day)
+            data = self.cache.get(self._period_info_url(
+                window_start, (window_end - window_start).days))
+            if data is None:
+                if missing_start is None:
+                    missing_start = window_start
+            else:
+                days.extend(data['Data'])
+                if missing_start is not None:
+                    days.extend(self._fetch_and_cache_period_info(
+                        missing_start, window_start, last_day))
+                    missing_start = None
+            window_start = window_end
+        if missing_start is not None:
+            days.extend(self._fetch_and_cache_period_info(
+                missing_start, end_day, last_day))
+        return days
+
+    def _fetch_and_cache_period_info(self, start_day, end_day, last_day):
+        """Return list of the period info of the days from start_day to
+        end_day, fetched and cached per window of CACHED_PERIOD_DAYS days.
+        Windows that end before last_day are cached as immutable.
+        """
+        days, fetched_end = self._fetch_period_info(start_day, end_day)
+        window_start = start_day
+        while window_start < fetched_end:
+            window_end = min(
+                window_start + timedelta(days=CACHED_PERIOD_DAYS), last_day)
+            period_end = min(window_end, fetched_end) - self.ONE_DAY
+            first, end = window_start.strftime(
+                '%Y-%m-%d'), window_end.strftime('%Y-%m-%d')
+            content = json.dumps({
+                'Data': [day for day in days if first <= day['Date'] < end],
+                'PeriodEnd': period_end.strftime('%Y-%m-%d'),
+            }).encode('utf8')
+            # last_day is at most the latest day with ecmf data, periods
+            # before it are not expected to change
+            self.cache.put(
+                self._period_info_url(
+                    window_start, (window_end - window_start).days),
+                content, immutable=period_end < last_day)
+            window_start = window_end
+        return days
+
+    def _fetch_period_info(self, start_day, end_day):
+        """Return (days, fetched_end) with list of the period info of the
+        days from start_day (inclusive) to end_day (exclusive), in as many
+        requests as needed, and the day after the last day that the
+        answers covered.
+        """
+        days = []
+        first, end = start_day.strftime('%Y-%m-%d'), end_day.strftime(
+            '%Y-%m-%d')
+        while start_day < end_day:
+            nrdays = (end_day - start_day).days
+            t0 = time.monotonic()
+            resp = self._get(self._period_info_url(start_day, nrdays))
+            data = resp.json()
+            self.period_length.observe(
+                nrdays, time.monotonic() - t0, len(resp.content))
+            days.extend(
+                day for day in data['Data'] if first <= day['Date'] < end)
+            period_end = datetime.strptime(
                 data['PeriodEnd'], '%Y-%m-%d') + self.ONE_DAY
+            if period_end <= start_day:
+                break
+            start_day = period_end
+        return days, min(start_day, end_day)
@@ -0,0 +1,174 @@
+import heapq
+import operator
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Sequence
+from itertools import filterfalse, groupby, islice
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from .scanids import ScanIDs
+
+# Number of scan ids handled at a time without numpy
+CHUNK_SIZE = 1000000
+
+
+class ScanIDSet(Sequence):
+    """Sorted set of scan ids kept in an array('Q'), 8 bytes per scan id
+    instead of the 60 or more of an int in a set.
+
+    Union, difference and intersection are vectorized by numpy if it is
+    installed. Without numpy they work on chunks of CHUNK_SIZE scan ids
+    and the scan ids of the other set in the range of the chunk. Items
+    compare equal to any sequence with the same scan ids in ascending
+    order.
+    """
+    __slots__ = ('_ids',)
+
+    def __init__(self, scanids=()):
+        if isinstance(scanids, ScanIDSet):
+            self._ids = scanids._ids
+        else:
+            self._ids = _sorted_unique(scanids)
+
+    @classmethod
+    def _from_sorted(cls, ids):
+        scanid_set = cls.__new__(cls)
+        scanid_set._ids = ids
+        return scanid_set
+
+    @classmethod
+    def from_file(cls, filename):
+        """Return ScanIDSet of the scan ids in a jobs file, see
+        ScanIDs.generate_from_file for the formats
+        """
+        return cls(ScanIDs.generate_from_file(filename))
+
+    def __len__(self):
+        return len(self._ids)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            if index.step is not None and index.step < 0:
+                return ScanIDSet(self._ids[index])
+            return self._from_sorted(self._ids[index])
+        return self._ids[index]
+
+    def __iter__(self):
+        return iter(self._ids)
+
+    def __contains__(self, scanid):
+        index = bisect_left(self._ids, scanid)
+        return index < len(self._ids) and self._ids[index] == scanid
+
+    def __eq__(self, other):
+        if isinstance(other, ScanIDSet):
+            return self._ids == other._ids
+        if isinstance(other, Sequence) and not isinstance(other, str):
+            return len(self) == len(other) and all(
+                map(operator.eq, self._ids, other))
+        return NotImplemented
+
+    __hash__ = None
+
+    def __repr__(self):
+        if len(self) > 6:
+            return 'ScanIDSet([{}, ..., {}] ({} scan ids))'.format(
+                ', '.join(map(str, self._ids[:3])),
+                ', '.join(map(str, self._ids[-3:])), len(self))
+        return 'ScanIDSet({})'.format(self._ids.tolist())
+
+    @property
+    def nbytes(self):
+        """Number of bytes used by the scan ids"""
+        return len(self._ids) * self._ids.itemsize
+
+    def union(self, other):
+        other = ScanIDSet(other)
+        if numpy is not None:
+            return self._from_numpy(numpy.union1d(
+                self._numpy(), other._numpy()))
+        return self._from_sorted(array('Q', heapq.merge(
+            self._ids, _filter_common(other._ids, self._ids, False))))
+
+    def difference(self, other):
+        other = ScanIDSet(other)
+        if numpy is not None:
+            return self._from_numpy(numpy.setdiff1d(
+                self._numpy(), other._numpy(), assume_unique=True))
+        return self._from_sorted(
+            _filter_common(self._ids, other._ids, False))
+
+    def intersection(self, other):
+        other = ScanIDSet(other)
+        if numpy is not None:
+            return self._from_numpy(numpy.intersect1d(
+                self._numpy(), other._numpy(), assume_unique=True))
+        return self._from_sorted(
+            _filter_common(self._ids, other._ids, True))
+
+    __or__ = union
+    __sub__ = difference
+    __and__ = intersection
+
+    def _numpy(self):
+        return numpy.frombuffer(self._ids, dtype=numpy.uint64) if len(
+            self._ids) else numpy.zeros(0, dtype=numpy.uint64)
+
+    @classmethod
+    def _from_numpy(cls, ids):
+        result = array('Q')
+        result.frombytes(ids.astype(numpy.uint64, copy=False).tobytes())
+        return cls._from_sorted(result)
+
+
+def _is_sorted(ids, strict=False):
+    compare = operator.lt if strict else operator.le
+    return all(map(compare, ids, islice(ids, 1, None)))
+
+
+def _sorted_unique_merge(ids):
+    """Return array('Q') of sorted scan ids without duplicates"""
+    return array('Q', (scanid for scanid, _ in groupby(ids)))
+
+
+def _sorted_unique(scanids):
+    """Return sorted array('Q') of the unique scan ids"""
+    ids = array('Q', scanids)
+    if _is_sorted(ids, strict=True):
+        return ids
+    if numpy is not None:
+        return ScanIDSet._from_numpy(numpy.unique(
+            numpy.frombuffer(ids, dtype=numpy.uint64)))._ids
+    if _is_sorted(ids):
+        return _sorted_unique_merge(ids)
+    # Sort a chunk at a time to bound the number of ints in memory
+    chunks = [
+        array('Q', sorted(ids[start:start + CHUNK_SIZE]))
+        for start in range(0, len(ids), CHUNK_SIZE)
+    ]
+    del ids
+    return _sorted_unique_merge(heapq.merge(*chunks))
+
+
+def _filter_common(ids, other, common):
+    """Return array('Q') of the sorted ids that are, if common, or are not
+    in the sorted other
+    """
+    result = array('Q')
+    other = memoryview(other)
+    for start in range(0, len(ids), CHUNK_SIZE):
+        chunk = ids[start:start + CHUNK_SIZE]
+        in_range = other[bisect_left(other, chunk[0]):
+                         bisect_right(other, chunk[-1])]
+        if len(in_range) <= len(chunk):
+            found = set(in_range)
+        else:
+            found = set(filter(set(chunk).__contains__, in_range))
+        result.extend((filter if common else filterfalse)(
+            found.__contains__, chunk))
+    other.release()
+    return result
@@ -0,0 +1,100 @@
+import gzip
+import json
+import os
+import threading
+
+from .jobrecords import EncodedBatch
+from .journal import append_row
+
+MANIFEST = 'manifest.ndjson'
+
+
+class SpoolError(Exception):
+    pass
+
+
+class Spool:
+    """Directory of job batches that are ready to be posted.
+
+    Each batch is a gzip compressed file with one job per row. The manifest
+    is an append-only file with one JSON object per row: a header with the
+    project, one row per spooled batch and one row per uploaded batch.
+    Uploading resumes from the manifest by skipping the uploaded batches.
+    """
+
+    def __init__(self, directory, project, create=True):
+        self.directory = directory
+        self.path = os.path.join(directory, MANIFEST)
+        self._lock = threading.Lock()
+        if not os.path.exists(self.path):
+            if not create:
+                raise SpoolError('No spool manifest in %s' % directory)
+            os.makedirs(directory, exist_ok=True)
+            self._append({'project': project})
+        self.project, self.batches, self.uploaded = self._read()
+        if self.project != project:
+            raise SpoolError('Spool %s holds jobs for project %s' % (
+                directory, self.project))
+        self._next = len(self.batches)
+
+    def _read(self):
+        project = None
+        batches = []
+        uploaded = set()
+        with open(self.path) as inp:
+            for row in inp:
+                try:
+                    entry = json.loads(row)
+                except ValueError:
+                    # The last row may be incomplete after a crash
+                    continue
+                if 'project' in entry:
+                    project = entry['project']
+                elif 'uploaded' in entry:
+                    uploaded.add(entry['uploaded'])
+                else:
+                    batches.append(entry)
+        return project, batches, uploaded
+
+    def _append(self, entry):
+        append_row(self.path, json.dumps(entry) + '\n')
+
+    def write(self, freqmode, jobs):
+        """Write a JobBatch to a new batch file and add it to the
+        manifest
+        """
+        with self._lock:
+            name = '{}-{:06d}.ndjson.gz'.format(freqmode, self._next)
+            self._next += 1
+        with gzip.open(os.path.join(self.directory, name), 'wb') as out:
+            out.write(b''.join(line + b'\n' for line in jobs.encode_lines()))
+        entry = {
+            'file': name,
+            'freqmode': freqmode,
+            'count': len(jobs),
+            'first': int(min(jobs.scanids)),
+            'last': int(max(jobs.scanids)),
+        }
+        with self._lock:
+            self._append(entry)
+            self.batches.append(entry)
+
+    def pending(self):
+        """Return list of the manifest entries of the batches that are not
+        uploaded
+        """
+        return [
+            entry for entry in self.batches
+            if entry['file'] not in self.uploaded
+        ]
+
+    def read(self, entry):
+        """Return the EncodedBatch of a manifest entry"""
+        with gzip.open(os.path.join(self.directory, entry['file'])) as inp:
+            return EncodedBatch([line.rstrip(b'\n') for line in inp])
+
+    def mark_uploaded(self, entry):
+        """Record in the manifest that the batch was accepted"""
+        with self._lock:
+            self._append({'uploaded': entry['file']})
+            self.uploaded.add(entry['file'])
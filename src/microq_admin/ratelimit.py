@@ -0,0 +1,62 @@
+import threading
+import time
+
+# Optional settings in the configuration file, in requests or jobs per second
+RATE_LIMIT_SETTINGS = {
+    'JOB_API_REQUESTS_PER_SECOND': ('JOB_API_ROOT', 'requests'),
+    'JOB_API_JOBS_PER_SECOND': ('JOB_API_ROOT', 'jobs'),
+    'ODIN_API_REQUESTS_PER_SECOND': ('ODIN_API_ROOT', 'requests'),
+}
+
+_limits = {}
+
+
+class TokenBucket:
+    """Thread safe token bucket that allows rate units per second on average
+    and bursts of at most burst units.
+
+    Callers that take more than is available reserve it and sleep until
+    their share has been refilled, so concurrent callers are served in order
+    and the rate holds however many threads there are.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst if burst is not None else max(rate, 1))
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self, amount=1):
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= amount
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0
+        if delay:
+            time.sleep(delay)
+
+
+def configure(config):
+    """Set up the rate limits in the configuration, replacing any earlier
+    limits.
+    """
+    _limits.clear()
+    for key, (api_root, unit) in RATE_LIMIT_SETTINGS.items():
+        if config.get(key):
+            _limits.setdefault(config[api_root], {})[unit] = TokenBucket(
+                float(config[key]))
+
+
+def limit(url, jobs=0):
+    """Wait until a request to url carrying jobs jobs is within the
+    configured rate limits.
+    """
+    for api_root, buckets in _limits.items():
+        if url.startswith(api_root):
+            if 'requests' in buckets:
+                buckets['requests'].acquire()
+            if jobs and 'jobs' in buckets:
+                buckets['jobs'].acquire(jobs)
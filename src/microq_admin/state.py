@@ -0,0 +1,56 @@
+import os
+import sqlite3
+import threading
+import time
+
+from .utils import STATE_DIR
+
+STATE_FILE = os.path.join(STATE_DIR, 'state.sqlite')
+
+
+class Watermarks:
+    """Persistent watermarks, e.g. the last day whose scans have all been
+    submitted, kept in a SQLite database shared by all tools.
+
+    A watermark is a string value stored under a name, e.g. the tool, and
+    a key, e.g. the project and freq mode.
+    """
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(
+            path, timeout=60, check_same_thread=False, isolation_level=None)
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS watermarks ('
+            'name TEXT NOT NULL, key TEXT NOT NULL, value TEXT NOT NULL,'
+            ' updated REAL NOT NULL, PRIMARY KEY (name, key))')
+
+    def get(self, name, key):
+        """Return the watermark, None if there is none"""
+        with self._lock:
+            row = self._db.execute(
+                'SELECT value FROM watermarks WHERE name = ? AND key = ?',
+                (name, key)).fetchone()
+        return row[0] if row is not None else None
+
+    def items(self, name, prefix=''):
+        """Return dict of key -> watermark of the keys starting with
+        prefix
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, value FROM watermarks WHERE name = ?'
+                ' AND substr(key, 1, ?) = ?',
+                (name, len(prefix), prefix)).fetchall()
+        return dict(rows)
+
+    def set(self, name, key, value):
+        with self._lock:
+            self._db.execute(
+                'INSERT OR REPLACE INTO watermarks (name, key, value, updated)'
+                ' VALUES (?, ?, ?, ?)', (name, key, value, time.time()))
+
+    def close(self):
+        self._db.close()
@@ -0,0 +1,106 @@
+import json
+import os
+import threading
+import time
+
+import requests
+
+from .utils import STATE_DIR
+
+TOKEN_CACHE = os.path.join(STATE_DIR, 'tokens.json')
+# Lifetime of a job api token in seconds when the service does not say
+TOKEN_LIFETIME = 600
+# Tokens are renewed this many seconds before they expire
+RENEW_MARGIN = 60
+# Stands in for a token that is not cached, it never equals a token
+_MISSING = object()
+
+
+class TokenError(Exception):
+    pass
+
+
+class TokenManager:
+    """Tokens for the job api.
+
+    Tokens are cached with their expiry time in memory, shared by all
+    managers in the process, and in a file that only the user can read,
+    shared by all invocations. A token is renewed RENEW_MARGIN seconds
+    before it expires.
+    """
+    _lock = threading.Lock()
+    _tokens = {}
+
+    def __init__(self, job_api_root, username, password, session=None,
+                 path=TOKEN_CACHE):
+        self.job_api_root = job_api_root
+        self.username = username
+        self.password = password
+        self.session = session or requests.Session()
+        self.path = path
+        self.key = '{}@{}'.format(username, job_api_root)
+
+    def get(self):
+        """Return (token, expires) with a token that is valid for at least
+        RENEW_MARGIN seconds, expires is a unix timestamp.
+        """
+        with self._lock:
+            cached = self._tokens.get(self.key)
+            if not self._is_fresh(cached) and self.path:
+                cached = self._read().get(self.key)
+            if not self._is_fresh(cached):
+                cached = self._fetch()
+                if self.path:
+                    self._write(cached)
+            self._tokens[self.key] = cached
+            return tuple(cached)
+
+    def invalidate(self, token):
+        """Forget the token, e.g. after the job service rejected it"""
+        with self._lock:
+            cached = self._tokens.get(self.key) or [_MISSING]
+            if cached[0] == token:
+                del self._tokens[self.key]
+            if not self.path:
+                return
+            cached = self._read().get(self.key) or [_MISSING]
+            if cached[0] == token:
+                self._write(None)
+
+    @staticmethod
+    def _is_fresh(cached):
+        return cached is not None and cached[1] - RENEW_MARGIN > time.time()
+
+    def _fetch(self):
+        r = self.session.get(
+            self.job_api_root + '/token',
+            auth=(self.username, self.password)
+        )
+        if r.status_code != 200:
+            raise TokenError('Get token returned %s' % r.status_code)
+        data = r.json()
+        return [
+            data['token'],
+            time.time() + data.get('duration', TOKEN_LIFETIME),
+        ]
+
+    def _read(self):
+        try:
+            with open(self.path) as inp:
+                return json.load(inp)
+        except (OSError, ValueError):
+            return {}
+
+    def _write(self, cached):
+        tokens = self._read()
+        if cached is None:
+            tokens.pop(self.key, None)
+        else:
+            tokens[self.key] = cached
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        tmp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)
+        with os.fdopen(fd, 'w') as out:
+            json.dump(tokens, out)
+        os.replace(tmp_path, self.path)
@@ -1,9 +1,18 @@
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
+from itertools import chain
+from sys import stderr
+import time
+import traceback
 import requests
+from requests.adapters import HTTPAdapter
 
-from ..utils import load_config, validate_config
+from .. import ratelimit
+from ..state import STATE_FILE, Watermarks
+from ..utils import load_config, ordered_map, validate_config
 from ..jobsgenerator.qsmrjobs import AddQsmrJobs
+from ..jobsgenerator.scanidset import ScanIDSet
 from .delete_project import InvalidConfig
 
 
@@ -13,6 +22,17 @@ DESCRIPTION = '''
 
 
 FIRST_DATE_TO_PROCESS = '2019-08-01'
+# Days of claimed jobs asked for per request, windows that fail are asked
+# for again one day at a time
+CLAIMED_WINDOW_DAYS = 30
+# Number of requests for claimed jobs made concurrently
+CONCURRENCY = 4
+# Number of days of level1 scans fetched concurrently
+LEVEL1_WORKERS = 8
+# Watermarks of the last day whose level1 scans are covered by claimed or
+# added jobs, per project and freqmode, and of the last full sweep
+WATERMARK = 'add_production_jobs_last_day'
+LAST_FULL_SWEEP = 'add_production_jobs_last_full'
 
 
 def validate_content_length(response):
@@ -27,11 +47,24 @@ def validate_content_length(response):
     return True
 
 
-def get(url, params, enforce_content_length):
+def make_session(pool_size):
+    """Return session that keeps up to pool_size connections per host"""
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_maxsize=pool_size)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def get(url, params, enforce_content_length, session=None):
     counter = 0
     is_valid = False
     while counter < 2:
-        r = requests.get(url, params=params)
+        ratelimit.limit(url)
+        if session is None:
+            r = requests.get(url, params=params)
+        else:
+            r = session.get(url, params=params)
         if r.ok:
             is_valid = True
         if is_valid and enforce_content_length:
@@ -42,6 +75,16 @@ def get(url, params, enforce_content_length):
     return is_valid, r
 
 
+def generate_windows(date_start, date_end, days):
+    """Generate (start, end) dates of consecutive windows of at most days
+    days from date_start to date_end
+    """
+    while date_start < date_end:
+        window_end = min(date_start + timedelta(days=days), date_end)
+        yield date_start, window_end
+        date_start = window_end
+
+
 def get_level2_projects(urlbase_odinapi):
     url = f'{urlbase_odinapi}/v5/level2/projects'
     return requests.get(url).json()['Data']
@@ -53,26 +96,79 @@ def get_latest_date_to_process(urlbase_odinapi):
     return datetime.strptime(date, '%Y-%m-%d').date()
 
 
-def get_level1_scans(
+def get_level1_scans_of_day(
+        url, day, enforce_content_length=True, session=None):
+    """Return list of the level1 scan ids of the day, None if they could
+    not be fetched
+    """
+    params = {
+        'start_time': day.strftime('%Y-%m-%d'),
+        'end_time': (day + timedelta(days=1)).strftime('%Y-%m-%d'),
+    }
+    is_valid, r = get(url, params, enforce_content_length, session)
+    if not is_valid:
+        stderr.write('Failed to get level1 scans of {}\n'.format(
+            params['start_time']))
+        return None
+    return [scan['ScanID'] for scan in r.json()['Data']]
+
+
+def generate_level1_scans(
     urlbase_odinapi,
     date_start,
     date_end,
     freqmode,
-    enforce_content_length=True
+    enforce_content_length=True,
+    workers=LEVEL1_WORKERS,
+    session=None,
+    failed_days=None,
 ):
-    scanids = []
+    """Generate the level1 scan ids from date_start to date_end.
+
+    The days are fetched by workers threads and the scan ids of each day
+    are generated as soon as it is fetched, not in date order. Days that
+    could not be fetched are skipped and appended to failed_days if given.
+    """
     url = f'{urlbase_odinapi}/v5/level1/{freqmode}/scans'
-    while date_start < date_end:
-        params = {
-            'start_time': date_start.strftime('%Y-%m-%d'),
-            'end_time': (date_start + timedelta(days=1)).strftime('%Y-%m-%d'),
+    days = [
+        day for day, _ in generate_windows(date_start, date_end, 1)]
+    with ThreadPoolExecutor(max(workers, 1)) as executor:
+        futures = {
+            executor.submit(
+                get_level1_scans_of_day, url, day, enforce_content_length,
+                session): day
+            for day in days
         }
-        is_valid, r = get(url, params, enforce_content_length)
-        if is_valid:
-            for scan in r.json()['Data']:
-                scanids.append(scan['ScanID'])
-        date_start += timedelta(days=1)
-    return scanids
+        try:
+            for future in as_completed(futures):
+                scanids = future.result()
+                if scanids is None:
+                    if failed_days is not None:
+                        failed_days.append(futures[future])
+                    continue
+                for scanid in scanids:
+                    yield scanid
+        finally:
+            # Do not fetch the rest if the generator is closed early
+            for future in futures:
+                future.cancel()
+
+
+def get_level1_scans(
+    urlbase_odinapi,
+    date_start,
+    date_end,
+    freqmode,
+    enforce_content_length=True,
+    workers=1,
+    session=None,
+):
+    """Return list of the level1 scan ids from date_start to date_end, in
+    date order if there is one worker
+    """
+    return list(generate_level1_scans(
+        urlbase_odinapi, date_start, date_end, freqmode,
+        enforce_content_length, workers, session))
 
 
 def get_processing_projects(urlbase_uservice):
@@ -81,29 +177,70 @@ def get_processing_projects(urlbase_uservice):
     return projects
 
 
-def get_claimed_jobs(
+def get_claimed_jobs_in_window(
+        url, date_start, date_end, enforce_content_length=True,
+        session=None):
+    """Return list of the ids of the jobs claimed from date_start to
+    date_end, asked for one day at a time if the window fails
+    """
+    params = {
+        'status': 'CLAIMED',
+        'start': date_start.strftime('%Y-%m-%dT00:00:00'),
+        'end': date_end.strftime('%Y-%m-%dT00:00:00'),
+    }
+    is_valid, r = get(url, params, enforce_content_length, session)
+    if is_valid:
+        return [job['Id'] for job in r.json()['Jobs']]
+    if (date_end - date_start).days > 1:
+        ids = []
+        for day_start, day_end in generate_windows(date_start, date_end, 1):
+            ids.extend(get_claimed_jobs_in_window(
+                url, day_start, day_end, enforce_content_length, session))
+        return ids
+    stderr.write('Failed to get claimed jobs from {} to {}\n'.format(
+        params['start'], params['end']))
+    return []
+
+
+def generate_claimed_jobs(
     urlbase_uservice,
     project,
     date_start,
-    enforce_content_length=True
+    enforce_content_length=True,
+    window_days=CLAIMED_WINDOW_DAYS,
+    concurrency=CONCURRENCY,
+    session=None,
 ):
+    """Generate the ids of the jobs claimed from date_start until today,
+    in date order.
+
+    The jobs are asked for in windows of window_days days, up to
+    concurrency windows at a time, so only the jobs of those windows are
+    held in memory.
+    """
     url = f'{urlbase_uservice}/v4/{project}/jobs'
     date_end = datetime.utcnow().date()
-    ids = []
-    while date_start < date_end:
-        params = {
-            'status': 'CLAIMED',
-            'start': date_start.strftime('%Y-%m-%dT00:00:00'),
-            'end': (
-                date_start + timedelta(days=1)
-            ).strftime('%Y-%m-%dT00:00:00'),
-        }
-        is_valid, r = get(url, params, enforce_content_length)
-        if is_valid:
-            for job in r.json()['Jobs']:
-                ids.append(job['Id'])
-        date_start += timedelta(days=1)
-    return ids
+    windows = ordered_map(
+        lambda window: get_claimed_jobs_in_window(
+            url, *window, enforce_content_length, session),
+        generate_windows(date_start, date_end, window_days), concurrency)
+    for ids in windows:
+        for jobid in ids:
+            yield jobid
+
+
+def get_claimed_jobs(
+    urlbase_uservice,
+    project,
+    date_start,
+    enforce_content_length=True,
+    window_days=CLAIMED_WINDOW_DAYS,
+    concurrency=CONCURRENCY,
+    session=None,
+):
+    return list(generate_claimed_jobs(
+        urlbase_uservice, project, date_start, enforce_content_length,
+        window_days, concurrency, session))
 
 
 def get_matching_projects(level2_projects, processing_projects):
@@ -122,30 +259,173 @@ def get_freqmode_from_jobid(jobid):
     return int(jobid.split(':')[0])
 
 
+def get_scanid_from_jobid(jobid):
+    return int(jobid.split(':')[1])
+
+
 def get_scanids_from_jobids(jobids):
-    return [int(id.split(':')[1]) for id in jobids]
+    return [get_scanid_from_jobid(id) for id in jobids]
 
 
-def add_jobs(config, processing_project, level2_project, freqmode, scanids):
+def add_jobs(config, processing_project, level2_project, freqmode, scanids,
+             since=None):
+    """Return (True if all batches were added, number of added jobs).
+    Jobs already in the project are not added again, only the jobs added
+    since the date since are looked for if it is given. The progress is
+    labelled with the project, which may be processed in parallel with
+    others.
+    """
     adder = AddQsmrJobs(
         processing_project, level2_project, config['ODIN_API_ROOT'],
         config['ODIN_SECRET'], config['JOB_API_ROOT'],
-        config['JOB_API_USERNAME'], config['JOB_API_PASSWORD']
+        config['JOB_API_USERNAME'], config['JOB_API_PASSWORD'],
+        skip_existing=True, existing_since=since
     )
-    adder.add_jobs(scanids, freqmode)
+    ok = adder.add_jobs(
+        scanids, freqmode, label='{}: '.format(level2_project))
+    return ok, adder.totals.get(freqmode, (0, {}))[0]
 
 
 def get_unprocessed_scanids(
-        urlbase_odinapi, urlbase_uservice, project_id, date_start, date_end):
-    jobids_claimed = get_claimed_jobs(urlbase_uservice, project_id, date_start)
-    if len(jobids_claimed) == 0:
-        return None, []
-    freqmode = get_freqmode_from_jobid(jobids_claimed[0])
-    scanids_claimed = get_scanids_from_jobids(jobids_claimed)
-    scanids_available = get_level1_scans(
-        urlbase_odinapi, date_start, date_end, freqmode)
-    unprocessed_scans = list(set(scanids_available) - set(scanids_claimed))
-    return freqmode, unprocessed_scans
+        urlbase_odinapi, urlbase_uservice, project_id, date_start, date_end,
+        workers=LEVEL1_WORKERS, session=None, counts=None, freqmode=None):
+    """Return (freqmode, ScanIDSet of the level1 scans without claimed
+    jobs). The freqmode is that of the first claimed job unless given,
+    (None, []) if it is not given and there are no claimed jobs. The
+    numbers of 'claimed' and 'available' scan ids, and the list of
+    'failed_days' whose level1 scans could not be fetched, are put in
+    counts if given.
+    """
+    if counts is None:
+        counts = {}
+    jobids_claimed = iter(generate_claimed_jobs(
+        urlbase_uservice, project_id, date_start, session=session))
+    if freqmode is None:
+        first_jobid = next(jobids_claimed, None)
+        if first_jobid is None:
+            return None, []
+        freqmode = get_freqmode_from_jobid(first_jobid)
+        jobids_claimed = chain([first_jobid], jobids_claimed)
+    # The job ids are not kept, only the scan ids
+    scanids_claimed = ScanIDSet(
+        get_scanid_from_jobid(jobid) for jobid in jobids_claimed
+        if get_freqmode_from_jobid(jobid) == freqmode)
+    # The scan ids of each day are added as soon as the day is fetched
+    counts['failed_days'] = []
+    scanids_available = ScanIDSet(generate_level1_scans(
+        urlbase_odinapi, date_start, date_end, freqmode, workers=workers,
+        session=session, failed_days=counts['failed_days']))
+    counts['claimed'] = len(scanids_claimed)
+    counts['available'] = len(scanids_available)
+    return freqmode, scanids_available - scanids_claimed
+
+
+def get_watermark(watermarks, project_id):
+    """Return (freqmode, last day (date)) of the latest reconciliation of
+    the project, (None, None) if it has not been reconciled
+    """
+    marks = watermarks.items(WATERMARK, '{}/'.format(project_id))
+    if not marks:
+        return None, None
+    key, last_day = min(marks.items(), key=lambda item: item[1])
+    return (
+        int(key.rsplit('/', 1)[1]),
+        datetime.strptime(last_day, '%Y-%m-%d').date())
+
+
+def full_sweep_due(watermarks, project_id, full_every):
+    """Return True if the last full sweep of the project is at least
+    full_every days old, False if full_every is None
+    """
+    if full_every is None:
+        return False
+    last_full = watermarks.get(LAST_FULL_SWEEP, str(project_id))
+    return last_full is None or (
+        datetime.strptime(last_full, '%Y-%m-%d').date()
+        <= datetime.utcnow().date() - timedelta(days=full_every))
+
+
+def set_watermark(watermarks, project_id, freqmode, date_end, full=False):
+    """Record that the scans before date_end are covered by jobs, and the
+    date of the sweep if it was full
+    """
+    # date_end is exclusive
+    last_day = (date_end - timedelta(days=1)).strftime('%Y-%m-%d')
+    key = '{}/{}'.format(project_id, freqmode)
+    if (watermarks.get(WATERMARK, key) or '') < last_day:
+        watermarks.set(WATERMARK, key, last_day)
+    if full:
+        watermarks.set(
+            LAST_FULL_SWEEP, str(project_id),
+            datetime.utcnow().date().strftime('%Y-%m-%d'))
+
+
+def process_project(
+        config, project, date_start, date_end, workers=LEVEL1_WORKERS,
+        session=None, watermarks=None, full=False, full_every=None):
+    """Add jobs for the unprocessed scans of a matching project, errors
+    are reported and do not propagate.
+
+    With watermarks only the days after the last day of the latest
+    successful run are reconciled, unless full or a full sweep is due
+    every full_every days. The last day is recorded when the run succeeds.
+
+    Returns:
+      dict: name, seconds, number of scans examined and jobs added, and
+        error (str), None if the project succeeded.
+    """
+    result = {
+        'name': project['name'], 'examined': 0, 'added': 0, 'error': None}
+    start = time.monotonic()
+    try:
+        date_from, freqmode = date_start, None
+        if watermarks is not None:
+            freqmode, last_day = get_watermark(watermarks, project['id'])
+            if last_day is not None and not (
+                    full or full_sweep_due(watermarks, project['id'],
+                                           full_every)):
+                date_from = max(date_start, last_day + timedelta(days=1))
+                print('{}: reconciled up to {}'.format(
+                    project['name'], last_day))
+        counts = {}
+        freqmode, scanids = get_unprocessed_scanids(
+            config['ODIN_API_ROOT'], config['JOB_API_ROOT'], project['id'],
+            date_from, date_end, workers=workers, session=session,
+            counts=counts, freqmode=freqmode
+        )
+        result['examined'] = counts.get('available', 0)
+        if len(scanids) > 0:
+            # Jobs for the scans since date_from were added after it
+            ok, result['added'] = add_jobs(
+                config, project['id'], project['name'], freqmode, scanids,
+                since=date_from if date_from != date_start else None)
+            if not ok:
+                result['error'] = 'not all jobs were added'
+        if counts.get('failed_days'):
+            # The days are not covered, they are reconciled again next time
+            result['error'] = 'failed to get level1 scans of {} days'.format(
+                len(counts['failed_days']))
+        if (watermarks is not None and freqmode is not None
+                and result['error'] is None):
+            set_watermark(
+                watermarks, project['id'], freqmode, date_end,
+                full=date_from == date_start)
+    except Exception as err:  # pylint: disable=broad-except
+        stderr.write('{}: {}'.format(project['name'], traceback.format_exc()))
+        result['error'] = str(err) or type(err).__name__
+    result['seconds'] = time.monotonic() - start
+    return result
+
+
+def print_summary(results):
+    print('Summary:')
+    for result in results:
+        print('  {name}: {added} jobs added, {examined} scans examined in '
+              '{seconds:.1f} s{failed}'.format(
+                  failed=(
+                      ', FAILED: {}'.format(result['error'])
+                      if result['error'] else ''),
+                  **result))
 
 
 def main(argv=[], config_file=None, prog=None):
@@ -154,10 +434,32 @@ def main(argv=[], config_file=None, prog=None):
         prog=prog,
         formatter_class=argparse.RawDescriptionHelpFormatter,
     )
-    parser.parse_args(argv)
+    parser.add_argument(
+        '--workers', type=int, default=LEVEL1_WORKERS, help=(
+            'number of days of level1 scans to fetch concurrently from the '
+            'odin api (default: %(default)s)'))
+    parser.add_argument(
+        '--parallel-projects', type=int, default=1, metavar='N', help=(
+            'number of projects to process concurrently, a project that '
+            'fails does not stop the others (default: %(default)s)'))
+    parser.add_argument('--full', action='store_true', help=(
+        'reconcile all days from {}, not only the days after the last '
+        'day of the latest successful run'.format(FIRST_DATE_TO_PROCESS)))
+    parser.add_argument(
+        '--full-every', type=int, metavar='DAYS', help=(
+            'reconcile all days if the last full reconciliation of the '
+            'project is at least DAYS days old, e.g. 7 for weekly'))
+    parser.add_argument('--state-file', default=STATE_FILE, help=(
+        'file of the reconciliation watermarks (default: %(default)s)'))
+    args = parser.parse_args(argv)
+    if args.parallel_projects < 1:
+        parser.error('--parallel-projects must be at least 1')
+    if args.full_every is not None and args.full_every < 1:
+        parser.error('--full-every must be at least 1')
     config = load_config(config_file)
     if not validate_config(config):
         raise InvalidConfig('Invalid config file.')
+    ratelimit.configure(config)
 
     date_start = datetime.strptime(
         FIRST_DATE_TO_PROCESS, '%Y-%m-%d').date()
@@ -168,12 +470,17 @@ def main(argv=[], config_file=None, prog=None):
         config['JOB_API_ROOT'])
     matching_projects = get_matching_projects(
         level2_projects, processing_projects)
-    for project in matching_projects:
-        freqmode, scanids = get_unprocessed_scanids(
-            config['ODIN_API_ROOT'], config['JOB_API_ROOT'], project['id'],
-            date_start, date_end
-        )
-        if len(scanids) == 0:
-            continue
-        add_jobs(
-            config, project['id'], project['name'], freqmode, scanids)
+    session = make_session(
+        max(args.workers, CONCURRENCY) * args.parallel_projects)
+    watermarks = Watermarks(args.state_file)
+    with ThreadPoolExecutor(args.parallel_projects) as executor:
+        results = list(executor.map(
+            lambda project: process_project(
+                config, project, date_start, date_end,
+                workers=args.workers, session=session,
+                watermarks=watermarks, full=args.full,
+                full_every=args.full_every),
+            matching_projects))
+    watermarks.close()
+    print_summary(results)
+    return int(any(result['error'] for result in results))
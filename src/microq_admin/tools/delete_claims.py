@@ -4,6 +4,7 @@ import sys
 import requests
 import threading
 
+from .. import ratelimit
 from ..utils import load_config, validate_config
 from ..projectsgenerator.qsmrprojects import is_project
 
@@ -30,6 +31,7 @@ class ThreadDelete(threading.Thread):
     def run(self):
         while True:
             url_claim = self.jobqueue.get()
+            ratelimit.limit(url_claim)
             status = requests.delete(url_claim, auth=self.auth)
             print("DELETE-CLAIM {} {}".format(status.url, status.status_code))
             self.jobqueue.task_done()
@@ -72,6 +74,7 @@ def delete_claim(project, config_file=None, force=False):
     config = load_config(config_file)
     if not validate_config(config):
         return 1
+    ratelimit.configure(config)
 
     project_uri, auth = get_project_uri_and_auth(project, config)
 
@@ -1,6 +1,13 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from sys import stderr
 
+from .ratelimit import RATE_LIMIT_SETTINGS
+
 CONFIG_PATH = '/odin.cfg'
+# Local state that is kept between runs, e.g. journals and caches
+STATE_DIR = os.path.expanduser('~/.microq_admin')
 
 CONFIG_FILE_DOCS = """The configuration file should contain these settings:
 ODIN_API_ROOT=https://example.com/odin_api
@@ -11,6 +18,11 @@ JOB_API_PASSWORD=<password>
 
 It may contain:
 JOB_API_VERSION=v4
+
+and rate limits that are shared by all threads of a run:
+JOB_API_REQUESTS_PER_SECOND=<max requests per second to the job api>
+JOB_API_JOBS_PER_SECOND=<max jobs per second added to the job api>
+ODIN_API_REQUESTS_PER_SECOND=<max requests per second to the odin api>
 """
 
 
@@ -37,7 +49,17 @@ def validate_config(config):
         if url.endswith('/'):
             error('%s must not end with /' % api_root)
 
-    optional = ['JOB_API_VERSION']
+    optional = ['JOB_API_VERSION'] + list(RATE_LIMIT_SETTINGS)
+
+    for key in RATE_LIMIT_SETTINGS:
+        if key not in config:
+            continue
+        try:
+            rate = float(config[key])
+        except ValueError:
+            rate = 0
+        if not rate > 0:
+            error('%s must be a positive number: %s' % (key, config[key]))
 
     if not set(config.keys()).issubset(required + optional):
         error("Config contains too invalid settings: {}".format(
@@ -65,3 +87,28 @@ def validate_project_name(project_name):
     if not project_name.isalnum():
         return False
     return True
+
+
+def ordered_map(function, items, concurrency):
+    """Generate function(item) for the items in order, computed
+    concurrently up to concurrency items ahead of the one generated.
+    The items are read one at a time as the results are generated.
+    """
+    if concurrency <= 1:
+        for item in items:
+            yield function(item)
+        return
+    window = deque()
+    with ThreadPoolExecutor(concurrency) as executor:
+        try:
+            for item in items:
+                window.append(executor.submit(function, item))
+                if len(window) < concurrency:
+                    continue
+                yield window.popleft().result()
+            while window:
+                yield window.popleft().result()
+        finally:
+            # Do not compute the rest if the generator is closed early
+            for future in window:
+                future.cancel()
@@ -3,6 +3,7 @@ from collections import namedtuple
 from datetime import date, datetime, timedelta
 import requests
 import tempfile
+import threading
 import pytest
 
 from .utils import SECRET_KEY
@@ -10,6 +11,7 @@ from microq_admin.tools import add_production_jobs
 from microq_admin.projectsgenerator.qsmrprojects import (
     create_project, delete_project, is_project
 )
+from microq_admin.state import Watermarks
 from microq_admin.utils import load_config
 from microq_admin.jobsgenerator.qsmrjobs import (
     main as jobsmain,
@@ -201,6 +203,31 @@ def test_get_level1_scans_mutliple_dates(mocked_requests):
     assert scanids == [1, 2, 3, 1, 2, 3]
 
 
+@patch('requests.get')
+def test_generate_level1_scans_as_days_complete(mocked_requests):
+    others_generated = threading.Event()
+
+    def get(url, params):
+        day = int(params['start_time'][-2:])
+        if day == 1:
+            # Answered after the scans of the other days are generated
+            assert others_generated.wait(5)
+        if day == 3:
+            return RESPONSE(json=dict, ok=False)
+        return RESPONSE(json=lambda: {
+            'Data': [{'ScanID': day * 10 + n} for n in range(2)]}, ok=True)
+    mocked_requests.side_effect = get
+    failed_days = []
+    scanids = add_production_jobs.generate_level1_scans(
+        URLBASE_ODINAPI, date(2000, 1, 1), date(2000, 1, 5), 1,
+        enforce_content_length=False, workers=4, failed_days=failed_days)
+    received = [next(scanids) for _ in range(4)]
+    others_generated.set()
+    assert sorted(received) == [20, 21, 40, 41]
+    assert list(scanids) == [10, 11]
+    assert failed_days == [date(2000, 1, 3)]
+
+
 @patch(
     'requests.get',
     return_value=RESPONSE(json=claimed_scans, ok=True)
@@ -227,6 +254,40 @@ def test_get_claimed_jobs(mocked_requests):
     assert jobids == ['1:101', '1:102', '1:103']
 
 
+def claimed_jobs_by_day(max_days):
+    """Return fake requests.get that answers with one claimed job per day
+    and fails for windows longer than max_days days
+    """
+    def get(url, params):
+        start = datetime.strptime(params['start'], '%Y-%m-%dT%H:%M:%S')
+        end = datetime.strptime(params['end'], '%Y-%m-%dT%H:%M:%S')
+        if (end - start).days > max_days:
+            return RESPONSE(json=dict, ok=False)
+        jobs = []
+        while start < end:
+            jobs.append({'Id': start.strftime('1:%Y%m%d')})
+            start += timedelta(days=1)
+        return RESPONSE(json=lambda: {'Jobs': jobs}, ok=True)
+    return get
+
+
+@pytest.mark.parametrize('max_days,requests_made', ((30, 3), (1, 2 * 3 + 65)))
+@patch('requests.get')
+def test_generate_claimed_jobs_in_windows(
+        mocked_requests, max_days, requests_made):
+    mocked_requests.side_effect = claimed_jobs_by_day(max_days)
+    today = datetime.utcnow().date()
+    date_start = today - timedelta(days=65)
+    jobids = add_production_jobs.generate_claimed_jobs(
+        URLBASE_USERVICE, 'p1', date_start, enforce_content_length=False,
+        window_days=30, concurrency=2)
+    assert list(jobids) == [
+        (date_start + timedelta(days=n)).strftime('1:%Y%m%d')
+        for n in range(65)
+    ]
+    assert mocked_requests.call_count == requests_made
+
+
 @pytest.mark.parametrize('jobid,expect', (
     ('1:100', 1), ('3:101', 3)
 ))
@@ -262,15 +323,15 @@ def test_add_jobs_get_called(mocked_add_jobs):
     }
     add_production_jobs.add_jobs(
         config, processing_project, level2_project, freqmode, scanids)
-    mocked_add_jobs.assert_called_with(scanids, freqmode)
+    mocked_add_jobs.assert_called_with(scanids, freqmode, label='proj2: ')
 
 
 @patch(
-    'microq_admin.tools.add_production_jobs.get_claimed_jobs',
+    'microq_admin.tools.add_production_jobs.generate_claimed_jobs',
     return_value=['1:101', '1:102', '1:103']
 )
 @patch(
-    'microq_admin.tools.add_production_jobs.get_level1_scans',
+    'microq_admin.tools.add_production_jobs.generate_level1_scans',
     return_value=[101, 102, 103, 104, 105]
 )
 def test_get_unprocessed_scanids_finds_data(
@@ -287,7 +348,7 @@ def test_get_unprocessed_scanids_finds_data(
 
 
 @patch(
-    'microq_admin.tools.add_production_jobs.get_claimed_jobs',
+    'microq_admin.tools.add_production_jobs.generate_claimed_jobs',
     return_value=[]
 )
 def test_get_unprocessed_scanids_no_claimed_jobs(
@@ -304,11 +365,11 @@ def test_get_unprocessed_scanids_no_claimed_jobs(
 
 
 @patch(
-    'microq_admin.tools.add_production_jobs.get_claimed_jobs',
+    'microq_admin.tools.add_production_jobs.generate_claimed_jobs',
     return_value=['1:101', '1:102', '1:103']
 )
 @patch(
-    'microq_admin.tools.add_production_jobs.get_level1_scans',
+    'microq_admin.tools.add_production_jobs.generate_level1_scans',
     return_value=[101, 102, 103]
 )
 def test_get_unprocessed_scanids_no_new_data(
@@ -324,6 +385,209 @@ def test_get_unprocessed_scanids_no_new_data(
     assert freqmode == 1 and scanids == []
 
 
+def fill_counts(*args, counts, **kwargs):
+    counts.update(claimed=3, available=5)
+    return 1, [104, 105]
+
+
+@patch(
+    'microq_admin.tools.add_production_jobs.add_jobs',
+    return_value=(True, 2)
+)
+@patch(
+    'microq_admin.tools.add_production_jobs.get_unprocessed_scanids',
+    side_effect=fill_counts
+)
+def test_process_project(mocked_unprocessed, mocked_add_jobs):
+    config = {'ODIN_API_ROOT': URLBASE_ODINAPI, 'JOB_API_ROOT': 'job'}
+    result = add_production_jobs.process_project(
+        config, {'name': 'p1', 'id': 'proj1'}, date(2019, 1, 1),
+        date(2019, 1, 10))
+    mocked_add_jobs.assert_called_once_with(
+        config, 'proj1', 'p1', 1, [104, 105], since=None)
+    assert result['name'] == 'p1' and result['error'] is None
+    assert result['examined'] == 5 and result['added'] == 2
+
+
+@patch(
+    'microq_admin.tools.add_production_jobs.get_unprocessed_scanids',
+    side_effect=RuntimeError('no answer')
+)
+def test_process_project_reports_errors(mocked_unprocessed):
+    result = add_production_jobs.process_project(
+        {'ODIN_API_ROOT': URLBASE_ODINAPI, 'JOB_API_ROOT': 'job'},
+        {'name': 'p1', 'id': 'proj1'}, date(2019, 1, 1), date(2019, 1, 10))
+    assert result['error'] == 'no answer' and result['added'] == 0
+
+
+WATERMARK_CONFIG = {'ODIN_API_ROOT': URLBASE_ODINAPI, 'JOB_API_ROOT': 'job'}
+WATERMARK_START = date(2019, 1, 1)
+
+
+@pytest.fixture
+def watermarks(tmp_path):
+    return Watermarks(str(tmp_path / 'state.sqlite'))
+
+
+def process_from_watermark(watermarks, date_end, claimed, available,
+                           added=(True, 1), **kwargs):
+    """Process project proj1 from WATERMARK_START with the claimed jobs and
+    the available level1 scans, which may also be a side effect.
+
+    Returns:
+      tuple: result, (first day, end day, freqmode) of the level1 scans
+        that were asked for and the add_jobs mock.
+    """
+    level1_scans = (
+        {'side_effect': available} if callable(available)
+        else {'return_value': available})
+    with patch(
+        'microq_admin.tools.add_production_jobs.generate_claimed_jobs',
+        return_value=claimed,
+    ) as mocked_claimed, patch(
+        'microq_admin.tools.add_production_jobs.generate_level1_scans',
+        **level1_scans
+    ) as mocked_level1_scans, patch(
+        'microq_admin.tools.add_production_jobs.add_jobs',
+        return_value=added,
+    ) as mocked_add_jobs:
+        result = add_production_jobs.process_project(
+            WATERMARK_CONFIG, {'name': 'p1', 'id': 'proj1'},
+            WATERMARK_START, date_end, watermarks=watermarks, **kwargs)
+    (_, date_from, date_to, freqmode), _ = mocked_level1_scans.call_args
+    assert mocked_claimed.call_args[0][2] == date_from
+    return result, (date_from, date_to, freqmode), mocked_add_jobs
+
+
+def set_watermark(watermarks, last_day, last_full_sweep=None):
+    watermarks.set(add_production_jobs.WATERMARK, 'proj1/1', last_day)
+    if last_full_sweep is not None:
+        watermarks.set(
+            add_production_jobs.LAST_FULL_SWEEP, 'proj1', last_full_sweep)
+
+
+def get_watermark(watermarks):
+    return watermarks.get(add_production_jobs.WATERMARK, 'proj1/1')
+
+
+def test_process_project_without_watermark(watermarks):
+    result, period, mocked_add_jobs = process_from_watermark(
+        watermarks, date(2019, 1, 10), ['1:101'], [101, 102])
+    assert result['error'] is None
+    assert period == (WATERMARK_START, date(2019, 1, 10), 1)
+    mocked_add_jobs.assert_called_once_with(
+        WATERMARK_CONFIG, 'proj1', 'p1', 1, [102], since=None)
+    assert get_watermark(watermarks) == '2019-01-09'
+    assert watermarks.get(
+        add_production_jobs.LAST_FULL_SWEEP, 'proj1') is not None
+
+
+def test_process_project_from_watermark(watermarks):
+    set_watermark(watermarks, '2019-01-09')
+    # Nothing was claimed since, the freqmode is that of the watermark
+    result, period, mocked_add_jobs = process_from_watermark(
+        watermarks, date(2019, 1, 12), [], [103])
+    assert result['error'] is None
+    assert period == (date(2019, 1, 10), date(2019, 1, 12), 1)
+    mocked_add_jobs.assert_called_once_with(
+        WATERMARK_CONFIG, 'proj1', 'p1', 1, [103], since=date(2019, 1, 10))
+    assert get_watermark(watermarks) == '2019-01-11'
+
+
+def test_process_project_full(watermarks):
+    set_watermark(watermarks, '2019-01-11')
+    result, period, _ = process_from_watermark(
+        watermarks, date(2019, 1, 12), [], [], full=True)
+    assert result['error'] is None
+    assert period[0] == WATERMARK_START
+
+
+@pytest.mark.parametrize('last_full_sweep,full_every,first_day', (
+    (None, 7, WATERMARK_START),
+    ('2019-01-01', 7, WATERMARK_START),
+    (datetime.utcnow().date().strftime('%Y-%m-%d'), 1, date(2019, 1, 12)),
+))
+def test_process_project_full_sweep_due(
+        watermarks, last_full_sweep, full_every, first_day):
+    set_watermark(watermarks, '2019-01-11', last_full_sweep)
+    result, period, _ = process_from_watermark(
+        watermarks, date(2019, 1, 12), [], [], full_every=full_every)
+    assert result['error'] is None
+    assert period[0] == first_day
+
+
+def test_process_project_keeps_watermark_before_failed_days(watermarks):
+    set_watermark(watermarks, '2019-01-11')
+
+    def level1_scans(*args, failed_days, **kwargs):
+        failed_days.append(date(2019, 1, 12))
+        return [104]
+    result, _, mocked_add_jobs = process_from_watermark(
+        watermarks, date(2019, 1, 14), [], level1_scans)
+    assert result['error'] == 'failed to get level1 scans of 1 days'
+    mocked_add_jobs.assert_called_once_with(
+        WATERMARK_CONFIG, 'proj1', 'p1', 1, [104], since=date(2019, 1, 12))
+    assert get_watermark(watermarks) == '2019-01-11'
+
+
+def test_process_project_keeps_watermark_when_adding_fails(watermarks):
+    set_watermark(watermarks, '2019-01-11')
+    result, _, _ = process_from_watermark(
+        watermarks, date(2019, 1, 14), [], [104], added=(False, 0))
+    assert result['error'] == 'not all jobs were added'
+    assert get_watermark(watermarks) == '2019-01-11'
+
+
+@patch(
+    'microq_admin.tools.add_production_jobs.get_latest_date_to_process',
+    return_value=date(2019, 1, 10)
+)
+@patch(
+    'microq_admin.tools.add_production_jobs.get_level2_projects',
+    return_value=[{'Name': 'p1'}, {'Name': 'p2'}, {'Name': 'p3'}]
+)
+@patch(
+    'microq_admin.tools.add_production_jobs.get_processing_projects',
+    return_value=[
+        {'Name': 'p1', 'Id': 1}, {'Name': 'p2', 'Id': 2},
+        {'Name': 'p3', 'Id': 3}
+    ]
+)
+@patch('microq_admin.tools.add_production_jobs.process_project')
+def test_main_parallel_projects(
+        mocked_process_project, mocked_processing, mocked_level2,
+        mocked_latest, capsys, tmp_path):
+    all_started = threading.Barrier(3, timeout=5)
+
+    def process_project(config, project, *args, **kwargs):
+        all_started.wait()
+        return {
+            'name': project['name'], 'seconds': 1.0, 'examined': 10,
+            'added': project['id'],
+            'error': 'failed' if project['name'] == 'p2' else None,
+        }
+    mocked_process_project.side_effect = process_project
+    with tempfile.NamedTemporaryFile(mode='w') as cfg:
+        cfg.write(
+            f'JOB_API_ROOT={URLBASE_USERVICE}\n'
+            'JOB_API_USERNAME=admin\n'
+            'JOB_API_PASSWORD=sqrrl\n'
+            f'ODIN_API_ROOT={URLBASE_ODINAPI}\n'
+            f'ODIN_SECRET={SECRET_KEY}\n'
+        )
+        cfg.flush()
+        assert add_production_jobs.main(
+            ['--parallel-projects', '3',
+             '--state-file', str(tmp_path / 'state.sqlite')],
+            config_file=cfg.name) == 1
+    assert capsys.readouterr().out.splitlines() == [
+        'Summary:',
+        '  p1: 1 jobs added, 10 scans examined in 1.0 s',
+        '  p2: 2 jobs added, 10 scans examined in 1.0 s, FAILED: failed',
+        '  p3: 3 jobs added, 10 scans examined in 1.0 s',
+    ]
+
+
 @pytest.fixture
 def config_file(odin_and_microq):
     odinurl, microqurl = odin_and_microq
@@ -379,11 +643,11 @@ def processing_project(config_file):
     return_value=[{'Name': 'odinproject'}]
 )
 @patch(
-    'microq_admin.tools.add_production_jobs.get_level1_scans',
+    'microq_admin.tools.add_production_jobs.generate_level1_scans',
     return_value=[101, 102, 103, 104, 105]
 )
 @patch(
-    'microq_admin.tools.add_production_jobs.get_claimed_jobs',
+    'microq_admin.tools.add_production_jobs.generate_claimed_jobs',
     return_value=['1:101', '1:102', '1:103']
 )
 def test_main(
@@ -392,7 +656,9 @@ def test_main(
         mocked_level2_projects,
         config_file,
         processing_project):
-    add_production_jobs.main(config_file=config_file.name)
+    add_production_jobs.main(
+        ['--state-file', config_file.name + '.db'],
+        config_file=config_file.name)
     config = load_config(config_file.name)
     jobs_project = processing_project
     r = requests.get(
@@ -0,0 +1,56 @@
+# pylint: disable=W0212
+import json
+import os
+from unittest.mock import patch
+
+import pytest
+
+from microq_admin.jobsgenerator.cache import ResponseCache
+
+
+@pytest.fixture
+def cache(tmp_path):
+    cache = ResponseCache(str(tmp_path), max_size=6000, ttl=60)
+    yield cache
+    cache.close()
+
+
+def body(value, size=0):
+    return json.dumps({'Data': value, 'Padding': os.urandom(size).hex()})
+
+
+def test_get_put(cache):
+    assert cache.get('http://odin/a') is None
+    cache.put('http://odin/a', body(1).encode(), immutable=True)
+    assert cache.get('http://odin/a')['Data'] == 1
+    assert len(os.listdir(cache.directory)) == 2
+
+
+def test_ttl(cache):
+    cache.put('http://odin/a', body(1).encode(), immutable=True)
+    cache.put('http://odin/b', body(2).encode())
+    assert cache.get('http://odin/b')['Data'] == 2
+    with patch('time.time', return_value=cache._db.execute(
+            'SELECT MAX(fetched) FROM entries').fetchone()[0] + 61):
+        assert cache.get('http://odin/a')['Data'] == 1
+        assert cache.get('http://odin/b') is None
+
+
+def test_lru_eviction(cache):
+    # Each body takes about 1700 bytes compressed
+    for name in 'abc':
+        cache.put('http://odin/' + name, body(name, 1600).encode())
+    cache.get('http://odin/a')
+    cache.put('http://odin/d', body('d', 1600).encode())
+    assert cache.get('http://odin/b') is None
+    assert [cache.get('http://odin/' + name)['Data'] for name in 'acd'] == [
+        'a', 'c', 'd']
+    assert len(os.listdir(cache.directory)) == 4
+
+
+def test_refresh(tmp_path):
+    ResponseCache(str(tmp_path)).put('http://odin/a', body(1).encode())
+    cache = ResponseCache(str(tmp_path), refresh=True)
+    assert cache.get('http://odin/a') is None
+    cache.put('http://odin/a', body(2).encode())
+    assert ResponseCache(str(tmp_path)).get('http://odin/a')['Data'] == 2
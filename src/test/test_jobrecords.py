@@ -0,0 +1,74 @@
+import json
+import time
+
+import pytest
+
+from .utils import SECRET_KEY
+from microq_admin.jobsgenerator import qsmrjobs
+from microq_admin.jobsgenerator.jobrecords import (
+    JobBatch, JobTemplate, encode_jobs,
+)
+
+ODIN_API_ROOT = 'http://example.com/odin "api"'
+ODIN_PROJECT = 'odinproject'
+
+
+def make_batch(scanids, freqmode=1):
+    targets = qsmrjobs.encode_level2_target_parameters(
+        ((scanid, freqmode) for scanid in scanids), ODIN_PROJECT, SECRET_KEY)
+    template = JobTemplate('qsmr', ODIN_API_ROOT, ODIN_PROJECT, freqmode)
+    return JobBatch(template, scanids, targets)
+
+
+def legacy_job(scanid, freqmode, target):
+    return {
+        'id': '%s:%s' % (freqmode, scanid),
+        'type': 'qsmr',
+        'source_url': ODIN_API_ROOT + '/v4/l1_log/{}/{}/'.format(
+            freqmode, scanid),
+        'target_url': ODIN_API_ROOT + '/v5/level2?d={}'.format(target),
+        'view_result_url': (
+            ODIN_API_ROOT + '/v5/level2/development/{}/{}/{}'.format(
+                ODIN_PROJECT, freqmode, scanid)),
+    }
+
+
+def test_encoded_batch_matches_job_dicts():
+    batch = make_batch(list(range(7123456780, 7123456790)), freqmode=13)
+    jobs = [
+        legacy_job(scanid, 13, target)
+        for scanid, target in zip(batch.scanids, batch.targets)
+    ]
+    assert json.loads(batch.encode()) == jobs
+    assert json.loads(encode_jobs(batch)) == jobs
+    assert json.loads(encode_jobs(jobs)) == jobs
+    assert list(batch) == jobs
+    assert batch[-1] == jobs[-1]
+    assert list(batch[2:4]) == jobs[2:4]
+
+
+@pytest.mark.slow
+def test_benchmark_encoded_batch():
+    """Compare building and encoding batches of jobs as dicts with json and
+    as a pre-encoded JobBatch"""
+    batch = make_batch(list(range(7123456780, 7123457780)))
+    rounds = 50
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        body = json.dumps([
+            legacy_job(scanid, 1, target)
+            for scanid, target in zip(batch.scanids, batch.targets)
+        ]).encode('utf8')
+    dict_time = (time.perf_counter() - start) / rounds
+
+    start = time.perf_counter()
+    for _ in range(rounds):
+        encoded = JobBatch(batch.template, batch.scanids, batch.targets)
+        encoded_body = encoded.encode()
+    batch_time = (time.perf_counter() - start) / rounds
+
+    print('1000 jobs: dicts and json {:.2f} ms, JobBatch {:.2f} ms'.format(
+        dict_time * 1e3, batch_time * 1e3))
+    assert json.loads(body) == json.loads(encoded_body)
+    assert batch_time * 3 < dict_time
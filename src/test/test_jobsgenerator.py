@@ -1,15 +1,37 @@
 # pylint: disable=W0212
 import base64
+import gzip
+import json
+import lzma
+import os
+import struct
+import sys
+import tempfile
+import threading
+import time
 import unittest
+from unittest.mock import patch, Mock
+from array import array
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import date, datetime, timedelta
 from io import BytesIO
+from urllib.parse import parse_qs, urlparse
 
 import pytest
+import requests
 from Crypto.Cipher import AES
 from Crypto.Random import get_random_bytes
 
-from .utils import SECRET_KEY
+from .utils import SECRET_KEY, StandInServer
 from microq_admin.jobsgenerator import qsmrjobs
-from microq_admin.jobsgenerator.scanids import ScanIDs
+from microq_admin.jobsgenerator.cache import ResponseCache
+from microq_admin.jobsgenerator.jobrecords import JobTemplate
+from microq_admin.jobsgenerator.journal import Journal
+from microq_admin.jobsgenerator.scanids import (
+    FREQMODE_TO_BACKEND, OdinAPIError, PeriodLength, ScanIDs,
+)
+from microq_admin.jobsgenerator.spool import Spool, SpoolError
+from microq_admin.tokens import TokenManager
 
 
 PROJECT_NAME = 'testproject'
@@ -26,8 +48,9 @@ class BaseTest(unittest.TestCase):
 
 
 class ResponseMock:
-    def __init__(self, status_code):
+    def __init__(self, status_code, headers=None):
         self.status_code = status_code
+        self.headers = headers or {}
 
 
 class TestConfigValidation(BaseTest):
@@ -113,8 +136,17 @@ class TestProjectNameValidation(BaseTest):
 class BaseTestAddJobs(BaseTest):
 
     @pytest.fixture(autouse=True)
-    def jobs(self, odin_and_microq):
+    def jobs(self, odin_and_microq, tmp_path, monkeypatch):
         odinurl, microqurl = odin_and_microq
+        # Keep the journals of runs without --journal-dir out of ~
+        monkeypatch.setattr(
+            qsmrjobs, 'JOURNAL_DIR', str(tmp_path / 'journal'))
+        # ... and the response and token caches
+        self._cache_dir = str(tmp_path / 'cache')
+        monkeypatch.setattr(qsmrjobs, 'CACHE_DIR', self._cache_dir)
+        monkeypatch.setattr(
+            qsmrjobs, 'TokenManager',
+            lambda *args, **kwargs: TokenManager(*args, path=None, **kwargs))
         self._apiroot = '{}/rest_api'.format(odinurl)
         self._write_config((
             f'ODIN_SECRET={SECRET_KEY}\n'
@@ -173,7 +205,7 @@ class TestAddJobsFromFile(BaseTestAddJobs):
         scanids = list(map(str, range(15)))
         freqmode = 1
         skip = 6
-        list_of_jobs = adder.filter_jobs(scanids, freqmode, skip)
+        list_of_jobs = list(adder.filter_jobs(scanids, freqmode, skip))
         self.assertEqual(len(list_of_jobs), 15 - skip)
 
     def test_skip(self):
@@ -188,6 +220,53 @@ class TestAddJobsFromFile(BaseTestAddJobs):
         self.assertEqual(len(self._mock_post_method.jobs), 1)
         self.assertEqual(len(self._mock_post_method.jobs[0]), 15 - skip)
 
+    def test_skip_binary(self):
+        """Test skipping of scan ids in a binary file"""
+        path = write_scanid_file(
+            tempfile.mkdtemp(), '.u64', list(range(100, 1600)))
+        exit_code = qsmrjobs.main([
+            PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1', '--jobs-file',
+            path, '--skip', '200',
+        ], CONFIG_FILE)
+        os.remove(path)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual([
+            len(jobs) for jobs in self._mock_post_method.jobs], [1000, 300])
+        self.assertEqual(self._mock_post_method.jobs[0][0]['id'], '1:300')
+        # Nothing is fetched from the odin api, so nothing is cached
+        self.assertFalse(os.path.exists(self._cache_dir))
+
+    def test_encrypt_processes(self):
+        """Test to add jobs with a pool of encryption processes"""
+        self._write_scanids(list(map(str, range(1500))))
+        exit_code = qsmrjobs.main([
+            PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1', '--jobs-file',
+            JOBS_FILE, '--encrypt-processes', '2',
+        ], CONFIG_FILE)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(len(self._mock_post_method.jobs), 2)
+        self.assertEqual(self._mock_post_method.jobs[1][-1]['id'], '1:1499')
+
+    def test_jobs_are_built_lazily(self):
+        """Test that each batch of jobs is built right before its post"""
+        adder = qsmrjobs.AddQsmrJobs(
+            PROJECT_NAME, ODIN_PROJECT, self._apiroot, f"{SECRET_KEY}",
+            "http://example.com", "testuser", "testpw")
+        consumed = []
+
+        def scanids():
+            for scanid in range(2500):
+                consumed.append(scanid)
+                yield scanid
+
+        def mock_post_method(self, jobs):  # pylint: disable=unused-argument
+            mock_post_method.consumed.append(len(consumed))
+            return ResponseMock(201)
+        mock_post_method.consumed = []
+        qsmrjobs.AddQsmrJobs._post_jobs = mock_post_method
+        self.assertTrue(adder.add_jobs(scanids(), 1))
+        self.assertEqual(mock_post_method.consumed, [1000, 2000, 2500])
+
 
 @pytest.mark.system
 class TestAddVds(BaseTestAddJobs):
@@ -267,6 +346,906 @@ class TestJobAPIFailure(BaseTestAddJobs):
         self.assertEqual(len(self._mock_post_method.jobs[0]), 1000)
 
 
+class TestSkipExisting(BaseTestAddJobs):
+
+    def test_skip_existing(self):
+        """Test that jobs already in the project are not added again"""
+        existing = Mock(status_code=200)
+        existing.iter_content.return_value = [json.dumps({'Jobs': [
+            {'Id': '1:3'}, {'Id': '2:4'}, {'Id': '1:5'}, {'Id': '1:1000'},
+        ]}).encode()]
+        self._write_scanids(list(map(str, range(10))))
+        with patch.object(
+                qsmrjobs.requests.Session, 'get',
+                return_value=existing) as mocked_get:
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--skip', '1', '--skip-existing',
+            ], CONFIG_FILE)
+        self.assertEqual(exit_code, 0)
+        mocked_get.assert_called_once_with(
+            'http://example.com/v4/{}/jobs'.format(PROJECT_NAME),
+            auth=(None, ''), stream=True, timeout=qsmrjobs.GET_JOBS_TIMEOUT)
+        existing.close.assert_called_once_with()
+        self.assertEqual(
+            [job['id'] for job in self._mock_post_method.jobs[0]],
+            ['1:1', '1:2', '1:4', '1:6', '1:7', '1:8', '1:9'])
+
+    def test_existing_since(self):
+        """Test to only look for the jobs added since a date"""
+        existing = Mock(status_code=200)
+        existing.iter_content.return_value = [b'{"Jobs": [{"Id": "1:3"}]}']
+        adder = qsmrjobs.AddQsmrJobs(
+            PROJECT_NAME, ODIN_PROJECT, self._apiroot, SECRET_KEY,
+            'http://example.com', 'testuser', 'testpw',
+            existing_since=date(2019, 1, 2))
+        with patch.object(
+                qsmrjobs.requests.Session, 'get',
+                return_value=existing) as mocked_get, patch.object(
+                    qsmrjobs.ratelimit, 'limit') as mocked_limit:
+            self.assertEqual(adder.get_existing_scanids(1), [3])
+        mocked_get.assert_called_once_with(
+            'http://example.com/v4/{}/jobs'.format(PROJECT_NAME),
+            auth=(None, ''), stream=True, timeout=qsmrjobs.GET_JOBS_TIMEOUT,
+            params={'start': '2019-01-02T00:00:00'})
+        mocked_limit.assert_called_once_with(
+            'http://example.com/v4/{}/jobs'.format(PROJECT_NAME))
+
+    def test_exclude_file(self):
+        """Test that scan ids in the exclude file are not added"""
+        self._write_scanids(list(map(str, range(10))))
+        with tempfile.TemporaryDirectory() as directory:
+            exclude_file = write_scanid_file(directory, '.gz', [8, 2, 5])
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--exclude-file', exclude_file,
+            ], CONFIG_FILE)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            [job['id'] for job in self._mock_post_method.jobs[0]],
+            ['1:0', '1:1', '1:3', '1:4', '1:6', '1:7', '1:9'])
+
+
+class TestResume(BaseTestAddJobs):
+
+    @staticmethod
+    def _get_mock_post_method():
+        def mock_post_method(self, job):  # pylint: disable=unused-argument
+            if len(mock_post_method.jobs) == mock_post_method.fail_at:
+                mock_post_method.fail_at = None
+                raise Exception('Failed!')
+            mock_post_method.jobs.append(job)
+            return ResponseMock(201)
+        mock_post_method.jobs = []
+        mock_post_method.fail_at = 2
+        return mock_post_method
+
+    def test_resume(self):
+        """Test to resume from the journal after a failed post"""
+        self._write_scanids(list(map(str, range(100, 4100))))
+        with tempfile.TemporaryDirectory() as journal_dir:
+            args = [
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--journal-dir', journal_dir,
+            ]
+            self.assertEqual(qsmrjobs.main(args, CONFIG_FILE), 1)
+            self.assertEqual(len(self._mock_post_method.jobs), 2)
+            self.assertEqual(
+                qsmrjobs.main(args + ['--resume'], CONFIG_FILE), 0)
+        ids = [
+            job['id'] for jobs in self._mock_post_method.jobs for job in jobs
+        ]
+        self.assertEqual(ids, ['1:%d' % scanid for scanid in range(100, 4100)])
+
+
+class TestSpool(BaseTestAddJobs):
+
+    @staticmethod
+    def _get_mock_post_method():
+        def mock_post_method(self, job):  # pylint: disable=unused-argument
+            if len(mock_post_method.jobs) == mock_post_method.fail_at:
+                mock_post_method.fail_at = None
+                raise Exception('Failed!')
+            mock_post_method.jobs.append(json.loads(job.encode()))
+            return ResponseMock(201)
+        mock_post_method.jobs = []
+        mock_post_method.fail_at = 2
+        return mock_post_method
+
+    def test_spool_and_upload(self):
+        """Test to spool jobs and upload them in two attempts"""
+        self._write_scanids(list(map(str, range(100, 4100))))
+        with tempfile.TemporaryDirectory() as spool_dir:
+            self.assertEqual(qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--spool', spool_dir,
+            ], CONFIG_FILE), 0)
+            self.assertEqual(self._mock_post_method.jobs, [])
+            self.assertEqual(len(Spool(spool_dir, PROJECT_NAME).pending()), 4)
+
+            args = [PROJECT_NAME, ODIN_PROJECT, '--upload', spool_dir]
+            self.assertEqual(qsmrjobs.main(args, CONFIG_FILE), 1)
+            self.assertEqual(len(self._mock_post_method.jobs), 3)
+            self.assertEqual(len(Spool(spool_dir, PROJECT_NAME).pending()), 1)
+            self.assertEqual(qsmrjobs.main(args, CONFIG_FILE), 0)
+            self.assertEqual(qsmrjobs.main(args, CONFIG_FILE), 0)
+        ids = sorted(
+            job['id'] for jobs in self._mock_post_method.jobs for job in jobs)
+        self.assertEqual(ids, sorted(
+            '1:%d' % scanid for scanid in range(100, 4100)))
+        job = self._mock_post_method.jobs[0][0]
+        self.assertEqual(job, JobTemplate(
+            'qsmr', self._apiroot, ODIN_PROJECT, 1,
+        ).job(100, job['target_url'].split('d=')[1]))
+
+    def test_spool_exclude_file(self):
+        """Test that scan ids in the exclude file are not spooled"""
+        self._write_scanids(list(map(str, range(10))))
+        with tempfile.TemporaryDirectory() as spool_dir:
+            exclude_file = write_scanid_file(spool_dir, '.txt', [8, 2, 5])
+            self.assertEqual(qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--skip', '1', '--spool',
+                spool_dir, '--exclude-file', exclude_file,
+            ], CONFIG_FILE), 0)
+            spool = Spool(spool_dir, PROJECT_NAME)
+            (entry,) = spool.pending()
+            jobs = json.loads(spool.read(entry).encode())
+        self.assertEqual(
+            [job['id'] for job in jobs],
+            ['1:1', '1:3', '1:4', '1:6', '1:7', '1:9'])
+
+    def test_upload_needs_spool(self):
+        """Test that upload fails without a spool"""
+        with tempfile.TemporaryDirectory() as spool_dir:
+            self.assertEqual(qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--upload', spool_dir,
+            ], CONFIG_FILE), 1)
+
+    def test_manifest(self):
+        """Test that the manifest survives an incomplete row and belongs to
+        one project
+        """
+        adder = make_adder('http://example.com')
+        with tempfile.TemporaryDirectory() as spool_dir:
+            spool = Spool(spool_dir, PROJECT_NAME)
+            for _, jobs in adder.generate_batches(range(10), 2, 0, 4):
+                spool.write(2, jobs)
+            spool.mark_uploaded(spool.batches[0])
+            with open(spool.path, 'a') as out:
+                out.write('{"uploaded": "2-0000')
+            spool = Spool(spool_dir, PROJECT_NAME)
+            self.assertEqual([
+                (entry['first'], entry['last'], entry['count'])
+                for entry in spool.pending()
+            ], [(4, 7, 4), (8, 9, 2)])
+            self.assertEqual(len(spool.read(spool.batches[2])), 2)
+            # Rows appended after the incomplete one are kept
+            spool.mark_uploaded(spool.batches[1])
+            self.assertEqual(
+                Spool(spool_dir, PROJECT_NAME).pending(), [spool.batches[2]])
+            with self.assertRaises(SpoolError):
+                Spool(spool_dir, 'otherproject')
+
+
+def write_scanid_file(directory, suffix, scanids):
+    """Write the scan ids to a file in the format given by suffix"""
+    path = os.path.join(directory, 'scanids' + suffix)
+    text = ''.join('%d\n' % scanid for scanid in scanids).encode()
+    data = array('Q', scanids)
+    if sys.byteorder != 'little':
+        data.byteswap()
+    if suffix == '.npy':
+        header = repr({
+            'descr': '<u8', 'fortran_order': False,
+            'shape': (len(scanids),)}).encode()
+        header += b' ' * (63 - (len(header) + 10) % 64) + b'\n'
+        content = (
+            b'\x93NUMPY\x01\x00' + struct.pack('<H', len(header)) + header
+            + data.tobytes())
+    elif suffix == '.u64':
+        content = data.tobytes()
+    elif suffix == '.gz':
+        content = gzip.compress(text)
+    elif suffix == '.xz':
+        content = lzma.compress(text)
+    elif suffix == '.zst':
+        content = pytest.importorskip('zstandard').ZstdCompressor().compress(
+            text)
+    else:
+        content = text
+    with open(path, 'wb') as out:
+        out.write(content)
+    return path
+
+
+@pytest.mark.parametrize('suffix', (
+    '.txt', '.gz', '.xz', '.zst', '.u64', '.npy'))
+@pytest.mark.parametrize('skip', (0, 3, 200000))
+def test_generate_from_file(tmp_path, suffix, skip):
+    scanids = [7014769646 + 3 * n for n in range(100000)]
+    path = write_scanid_file(str(tmp_path), suffix, scanids)
+    assert list(ScanIDs.generate_from_file(path, skip=skip)) == (
+        scanids[skip:])
+
+
+def test_generate_from_text_file_rows(tmp_path):
+    path = os.path.join(str(tmp_path), 'scanids.txt')
+    with open(path, 'w') as out:
+        out.write('\n 1\r\n\n22  \n333')
+    assert list(ScanIDs.generate_from_file(path)) == [1, 22, 333]
+
+
+def test_generate_from_empty_binary_file(tmp_path):
+    path = write_scanid_file(str(tmp_path), '.u64', [])
+    assert list(ScanIDs.generate_from_file(path)) == []
+
+
+class TestJournal(unittest.TestCase):
+
+    def test_filter(self):
+        """Test that ids in acknowledged batches are skipped"""
+        with tempfile.TemporaryDirectory() as journal_dir:
+            journal = Journal(PROJECT_NAME, 1, journal_dir)
+            self.assertEqual(journal.acknowledged(), [])
+            journal.record([10, 11, 12])
+            journal.record([20, 21])
+            journal.record([14, 13])
+            # Only the ids of the batches are skipped, not those between
+            journal.record([100, 5])
+            with open(journal.path, 'a') as out:
+                out.write('batch 2 30 3')
+            self.assertEqual(
+                journal.acknowledged(), [5, 10, 11, 12, 13, 14, 20, 21, 100])
+            self.assertEqual(
+                list(journal.filter(range(5, 25))),
+                list(range(6, 10)) + list(range(15, 20)) + [22, 23, 24])
+            self.assertEqual(journal.nr_skipped, 8)
+            self.assertEqual(
+                os.path.basename(journal.path), PROJECT_NAME + '-1.journal')
+            # Rows recorded after the incomplete one are kept
+            journal.record([30, 3])
+            self.assertEqual(
+                journal.acknowledged(),
+                [3, 5, 10, 11, 12, 13, 14, 20, 21, 30, 100])
+
+
+class TestConcurrentAddJobs(BaseTestAddJobs):
+
+    @staticmethod
+    def _get_mock_post_method():
+        def mock_post_method(self, job):  # pylint: disable=unused-argument
+            with mock_post_method.lock:
+                mock_post_method.in_flight += 1
+                mock_post_method.max_in_flight = max(
+                    mock_post_method.max_in_flight,
+                    mock_post_method.in_flight)
+                if mock_post_method.in_flight == 4:
+                    mock_post_method.all_in_flight.set()
+                token = self.token
+            # Hold the first posts until four batches are in flight
+            mock_post_method.all_in_flight.wait(5)
+            with mock_post_method.lock:
+                mock_post_method.in_flight -= 1
+            if token != 'renewed':
+                return ResponseMock(401)
+            mock_post_method.jobs.append(job)
+            return ResponseMock(201)
+        mock_post_method.jobs = []
+        mock_post_method.lock = threading.Lock()
+        mock_post_method.in_flight = 0
+        mock_post_method.max_in_flight = 0
+        mock_post_method.all_in_flight = threading.Event()
+        return mock_post_method
+
+    def test_concurrency(self):
+        """Test that batches are posted concurrently with one token
+        renewal shared by all workers"""
+        renewals = []
+
+        def get_token(adder):
+            renewals.append(adder.token)
+            adder.token = 'renewed' if adder.token else 'expired'
+
+        qsmrjobs.AddQsmrJobs.get_token = get_token
+        self._write_scanids(list(map(str, range(8500))))
+        exit_code = qsmrjobs.main([
+            PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1', '--jobs-file',
+            JOBS_FILE, '--concurrency', '4',
+        ], CONFIG_FILE)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(renewals, [None, 'expired'])
+        self.assertEqual(self._mock_post_method.max_in_flight, 4)
+        self.assertEqual(len(self._mock_post_method.jobs), 9)
+        self.assertEqual(
+            sorted(job['id'] for jobs in self._mock_post_method.jobs
+                   for job in jobs),
+            sorted('1:%d' % scanid for scanid in range(8500)))
+
+
+class TestAdaptiveAddJobs(BaseTestAddJobs):
+
+    @staticmethod
+    def _get_mock_post_method():
+        def mock_post_method(self, job):  # pylint: disable=unused-argument
+            mock_post_method.jobs.append(job)
+            if len(mock_post_method.jobs) == 2:
+                return ResponseMock(503)
+            return ResponseMock(201)
+        mock_post_method.jobs = []
+        return mock_post_method
+
+    def test_adaptive_batch_size(self):
+        """Test that fast posts grow the batch size and errors shrink it"""
+        self._write_scanids(list(map(str, range(7000))))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--adaptive-batch-size',
+                '--min-batch-size', '500', '--max-batch-size', '3000',
+                '--retries', '0', '--journal-dir', tmpdir,
+                '--dead-letter', os.path.join(tmpdir, 'failed.txt'),
+            ], CONFIG_FILE)
+        # The batch that got 503 is a dead letter
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(
+            [len(jobs) for jobs in self._mock_post_method.jobs],
+            [1000, 2000, 1000, 2000, 1000])
+
+
+class TestAdaptiveBatchSize(unittest.TestCase):
+
+    def test_observe(self):
+        """Test growth towards the target latency within the limits"""
+        size = qsmrjobs.AdaptiveBatchSize(100, 5000, 10)
+        self.assertEqual(int(size), 1000)
+        size.observe(1000, 4, 201)
+        self.assertEqual(int(size), 2000)
+        size.observe(2000, 8, 201)
+        self.assertEqual(int(size), 2500)
+        size.observe(2500, 50, 201)
+        self.assertEqual(int(size), 1250)
+        size.observe(1250, None, None)
+        self.assertEqual(int(size), 625)
+        size.observe(625, 1, 502)
+        size.observe(312, 1, 502)
+        size.observe(156, 1, 502)
+        self.assertEqual(int(size), 100)
+        for _ in range(10):
+            size.observe(int(size), 0.1, 201)
+        self.assertEqual(int(size), 5000)
+
+
+class TestProgress(unittest.TestCase):
+
+    def test_offset_follows_lowest_acknowledged_batch(self):
+        """Test that the resume offset only passes acknowledged batches"""
+        progress = qsmrjobs._Progress(10)
+        progress.acknowledge(1, 100)
+        self.assertEqual(progress.offset, 10)
+        progress.acknowledge(0, 100)
+        self.assertEqual(progress.offset, 210)
+        progress.acknowledge(3, 50)
+        self.assertEqual(progress.offset, 210)
+        self.assertEqual(progress.nr_added, 250)
+
+
+class TestRetries(BaseTestAddJobs):
+
+    @staticmethod
+    def _get_mock_post_method():
+        def mock_post_method(self, job):  # pylint: disable=unused-argument
+            mock_post_method.jobs.append(job)
+            if job[0]['id'] == '1:1000':
+                return ResponseMock(502)
+            if job[0]['id'] == '1:0' and len(mock_post_method.jobs) == 1:
+                raise qsmrjobs.requests.ConnectionError('Failed!')
+            if job[0]['id'] == '1:2000' and len(mock_post_method.jobs) == 6:
+                return ResponseMock(503, {'Retry-After': '0'})
+            return ResponseMock(201)
+        mock_post_method.jobs = []
+        return mock_post_method
+
+    def test_dead_letters(self):
+        """Test that transient errors are retried and that batches that
+        still fail go to the dead letter file"""
+        self._write_scanids(list(map(str, range(3500))))
+        with tempfile.TemporaryDirectory() as tmpdir:
+            dead_letter = os.path.join(tmpdir, 'failed.txt')
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1',
+                '--jobs-file', JOBS_FILE, '--retries', '2',
+                '--retry-backoff', '0.01', '--dead-letter', dead_letter,
+                '--journal-dir', tmpdir,
+            ], CONFIG_FILE)
+            with open(dead_letter) as inp:
+                failed = [int(row) for row in inp]
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(
+            [jobs[0]['id'] for jobs in self._mock_post_method.jobs],
+            ['1:0', '1:0', '1:1000', '1:1000', '1:1000', '1:2000',
+             '1:2000', '1:3000'])
+        self.assertEqual(failed, list(range(1000, 2000)))
+
+    def test_retry_delay(self):
+        """Test exponential backoff and Retry-After"""
+        adder = qsmrjobs.AddQsmrJobs(
+            PROJECT_NAME, ODIN_PROJECT, self._apiroot, f"{SECRET_KEY}",
+            "http://example.com", "testuser", "testpw", retry_backoff=2)
+        for attempt in range(4):
+            self.assertLessEqual(adder._retry_delay(attempt), 2 ** attempt * 2)
+        self.assertEqual(adder._retry_delay(0, '7'), 7)
+        self.assertEqual(
+            adder._retry_delay(0, 'Wed, 21 Oct 2015 07:28:00 GMT'), 0)
+        # An unparseable header falls back to the backoff
+        self.assertLessEqual(adder._retry_delay(3, 'soon'), 2 ** 3 * 2)
+
+
+@pytest.fixture
+def job_api():
+    def handle(request, body):
+        if request.path == '/token':
+            return 200, {'token': 'token'}
+        encoding = request.headers.get('Content-Encoding')
+        handle.encodings.append(encoding)
+        if encoding in handle.rejected:
+            return 415, {}
+        if encoding == 'gzip':
+            body = gzip.decompress(body)
+        handle.jobs.append(json.loads(body))
+        return 201, {}
+    handle.encodings = []
+    handle.jobs = []
+    handle.rejected = ()
+    server = StandInServer(handle)
+    yield server
+    server.close()
+
+
+def make_adder(job_api_root, **kwargs):
+    token_manager = TokenManager(job_api_root, 'testuser', 'testpw', path=None)
+    return qsmrjobs.AddQsmrJobs(
+        PROJECT_NAME, ODIN_PROJECT, 'http://example.com/odin', SECRET_KEY,
+        job_api_root, 'testuser', 'testpw', token_manager=token_manager,
+        **kwargs)
+
+
+def test_gzip_compressed_posts(job_api):
+    adder = make_adder(job_api.url, compression='gzip')
+    assert adder.add_jobs(range(1500), 1)
+    assert job_api.handle.encodings == ['gzip', 'gzip']
+    assert [len(jobs) for jobs in job_api.handle.jobs] == [1000, 500]
+    assert job_api.handle.jobs[1][-1] == adder.make_job_data(
+        1499, 1, job_api.handle.jobs[1][-1]['target_url'].split('d=')[1])
+
+
+def test_zstd_compression():
+    zstandard = pytest.importorskip('zstandard')
+    data = json.dumps([{'id': '1:%d' % scanid} for scanid in range(100)])
+    compressed = qsmrjobs.compress(data.encode(), 'zstd')
+    assert len(compressed) < len(data)
+    assert zstandard.ZstdDecompressor().decompress(
+        compressed).decode() == data
+
+
+def test_uncompressed_fallback_on_415(job_api):
+    job_api.handle.rejected = ('gzip',)
+    adder = make_adder(job_api.url, compression='gzip')
+    assert adder.add_jobs(range(1500), 1)
+    assert job_api.handle.encodings == ['gzip', None, None]
+    assert [len(jobs) for jobs in job_api.handle.jobs] == [1000, 500]
+    assert adder.compression is None
+
+
+class FakeOdinAPI:
+    """Routes for a stand-in odin api with three scans per day in freqmodes
+    1 and 2 from 2015-01-01 to 2015-01-19 and ecmf data up to 2015-01-10.
+    """
+    FIRST_DAY = date(2015, 1, 1)
+    LAST_DAY = date(2015, 1, 19)
+    LATEST_ECMF = '2015-01-10'
+    FREQMODES = (1, 2)
+
+    def __init__(self):
+        self.requests = []
+        self.lock = threading.Lock()
+        # Seconds to wait before answering a day log request
+        self.log_delay = 0
+        self.logs_in_flight = 0
+        self.max_logs_in_flight = 0
+        # Seconds to wait before answering a period info request
+        self.period_delay = 0
+        self.periods_in_flight = 0
+        self.max_periods_in_flight = 0
+        # Most days in a period info answer, None for no limit
+        self.max_period_days = None
+        # Status codes of the answers to the next period info requests
+        self.period_errors = []
+        # Status codes of the day logs by '{freqmode}/{day}'
+        self.log_errors = {}
+        self.server = StandInServer(self.handle)
+        self.url = self.server.url
+
+    @classmethod
+    def scanids(cls, freqmode, day):
+        offset = (day - cls.FIRST_DAY).days
+        return [freqmode * 10000 + offset * 10 + n for n in range(3)]
+
+    def handle(self, request, body):  # pylint: disable=unused-argument
+        url = urlparse(request.path)
+        with self.lock:
+            self.requests.append(url.path)
+        parts = url.path.strip('/').split('/')
+        if url.path == '/v5/config_data/latest_ecmf_file':
+            return 200, {'Date': self.LATEST_ECMF}
+        if parts[:2] == ['v5', 'period_info']:
+            with self.lock:
+                if self.period_errors:
+                    return self.period_errors.pop(0), {}
+                self.periods_in_flight += 1
+                self.max_periods_in_flight = max(
+                    self.max_periods_in_flight, self.periods_in_flight)
+            start = date(*map(int, parts[2:5]))
+            length = int(parse_qs(url.query)['length'][0])
+            if self.max_period_days is not None:
+                length = min(length, self.max_period_days)
+            end = min(start + timedelta(days=length - 1), self.LAST_DAY)
+            # Answer later periods faster to check that the order is kept
+            time.sleep(self.period_delay * (20 - start.day) / 20)
+            with self.lock:
+                self.periods_in_flight -= 1
+            data = []
+            day = max(start, self.FIRST_DAY)
+            while day <= end:
+                for freqmode in self.FREQMODES:
+                    data.append({
+                        'Date': day.isoformat(), 'FreqMode': freqmode,
+                        'NumScan': 3, 'URL': '{}/log/{}/{}'.format(
+                            self.url, freqmode, day.isoformat())})
+                day += timedelta(days=1)
+            return 200, {'Data': data, 'PeriodEnd': end.isoformat()}
+        if parts[:2] == ['v4', 'vds']:
+            freqmode = int(parts[3])
+            return 200, {'VDS': [
+                {'Info': {'ScanID': scanid, 'FreqMode': freqmode}}
+                for scanid in self.expected(freqmode)]}
+        if parts[0] == 'log':
+            if '/'.join(parts[1:3]) in self.log_errors:
+                return self.log_errors['/'.join(parts[1:3])], {}
+            day = date(*map(int, parts[2].split('-')))
+            with self.lock:
+                self.logs_in_flight += 1
+                self.max_logs_in_flight = max(
+                    self.max_logs_in_flight, self.logs_in_flight)
+            # Answer later days faster to check that the order is kept
+            time.sleep(self.log_delay * (20 - day.day) / 20)
+            with self.lock:
+                self.logs_in_flight -= 1
+            return 200, {'Data': [
+                {'ScanID': scanid}
+                for scanid in self.scanids(int(parts[1]), day)]}
+        return 404, {}
+
+    def expected(self, freqmode, start=FIRST_DAY, end=date(2015, 1, 10)):
+        scanids = []
+        while start < end:
+            scanids.extend(self.scanids(freqmode, start))
+            start += timedelta(days=1)
+        return scanids
+
+
+@pytest.fixture
+def odin_api():
+    api = FakeOdinAPI()
+    yield api
+    api.server.close()
+
+
+def test_generate_all_freqmodes(odin_api):
+    scanids = ScanIDs(odin_api.url)
+    sources = scanids.generate_all_freqmodes(
+        [1, 2], start_day='2015-01-03', end_day='2015-01-08')
+    assert list(sources[2]) == odin_api.expected(
+        2, date(2015, 1, 3), date(2015, 1, 8))
+    assert list(sources[1]) == odin_api.expected(
+        1, date(2015, 1, 3), date(2015, 1, 8))
+    assert len([
+        path for path in odin_api.requests if 'period_info' in path]) == 1
+    assert list(scanids.generate_all(1)) == odin_api.expected(1)
+
+
+@pytest.mark.parametrize('prefetch', (1, 4))
+def test_generate_all_prefetches_day_logs(odin_api, prefetch):
+    odin_api.log_delay = 0.05
+    scanids = ScanIDs(odin_api.url, prefetch=prefetch)
+    assert list(scanids.generate_all(1)) == odin_api.expected(1)
+    assert odin_api.max_logs_in_flight == prefetch
+
+
+def test_prefetch_stops_when_closed(odin_api):
+    scanids = ScanIDs(odin_api.url, prefetch=4)
+    generator = scanids.generate_all(1)
+    assert next(generator) == odin_api.expected(1)[0]
+    generator.close()
+    # Only the first window of day logs was fetched
+    assert len([path for path in odin_api.requests if 'log/' in path]) <= 5
+
+
+@pytest.mark.parametrize('prefetch', (1, 4))
+def test_generate_days_with_scans_in_windows(odin_api, prefetch):
+    odin_api.period_delay = 0.05
+    odin_api.max_period_days = 2
+    scanids = ScanIDs(odin_api.url, prefetch=prefetch)
+    start = datetime(2015, 1, 1)
+    days = list(scanids.generate_days_with_scans(
+        start, datetime(2015, 1, 10), [1, 2], step_size=3))
+    assert [day[0] for day in days] == sorted(
+        (start + timedelta(days=n)).strftime('%Y-%m-%d')
+        for n in range(9) for _ in range(2))
+    assert [day[3] for day in days] == [1, 2] * 9
+    # Three windows of three days, each fetched two days at a time
+    assert len(odin_api.requests) == 6
+    assert odin_api.max_periods_in_flight == min(prefetch, 3)
+
+
+def test_requests_are_limited(odin_api):
+    odin_api.log_delay = 0.05
+    scanids = ScanIDs(odin_api.url, prefetch=4, pool_size=3)
+    sources = scanids.generate_all_freqmodes([1, 2])
+    with ThreadPoolExecutor(2) as executor:
+        results = list(executor.map(list, [sources[1], sources[2]]))
+    assert results == [odin_api.expected(1), odin_api.expected(2)]
+    assert odin_api.max_logs_in_flight == 3
+
+
+def test_period_length_adapts():
+    length = PeriodLength(days=100, min_days=10, max_days=1000,
+                          target_latency=1, target_bytes=1000)
+    length.observe(100, 0.5, 100)
+    assert int(length) == 200
+    length.observe(200, 0.5, 1000)
+    assert int(length) == 200
+    length.observe(200, 10, 1000)
+    assert int(length) == 100
+    for _ in range(10):
+        length.observe(int(length), 100, 1000)
+    assert int(length) == 10
+
+
+def test_period_info_retries(odin_api):
+    odin_api.period_errors = [503, 502]
+    scanids = ScanIDs(odin_api.url, retry_backoff=0)
+    assert list(scanids.generate_all(1)) == odin_api.expected(1)
+
+
+@pytest.mark.parametrize('errors', ([503] * 3, [404]))
+def test_period_info_fails(odin_api, errors):
+    odin_api.period_errors = errors[:]
+    scanids = ScanIDs(odin_api.url, retries=2, retry_backoff=0)
+    with pytest.raises(OdinAPIError):
+        list(scanids.generate_all(1, '2015-01-01'))
+    assert odin_api.requests.count(
+        '/v5/period_info/2015/01/01/') == len(errors)
+
+
+def test_session_and_timeouts(odin_api):
+    session = requests.Session()
+    timeouts = []
+    orig_get = session.get
+
+    def get(url, **kwargs):
+        timeouts.append(kwargs['timeout'])
+        return orig_get(url, **kwargs)
+    session.get = get
+    scanids = ScanIDs(odin_api.url, session=session, timeout=(1, 5))
+    assert list(scanids.generate_all(1)) == odin_api.expected(1)
+    assert scanids.get_latest_ecmf_day() == FakeOdinAPI.LATEST_ECMF
+    assert len(timeouts) == len(odin_api.requests)
+    assert set(timeouts) == {(1, 5)}
+    assert odin_api.requests.count('/v5/config_data/latest_ecmf_file') == 1
+
+
+@pytest.mark.parametrize('use_cache', (False, True))
+def test_generate_vds(odin_api, tmp_path, use_cache):
+    cache = ResponseCache(str(tmp_path)) if use_cache else None
+    scanids = ScanIDs(odin_api.url, cache=cache)
+    assert list(scanids.generate_vds(2)) == odin_api.expected(2)
+    assert list(scanids.generate_vds(2)) == odin_api.expected(2)
+    assert len(odin_api.requests) == (1 if use_cache else 2)
+
+
+def test_generate_all_from_cache(odin_api, tmp_path):
+    def fetched():
+        paths = odin_api.requests[:]
+        del odin_api.requests[:]
+        return [path for path in paths if 'latest_ecmf' not in path]
+
+    scanids = ScanIDs(
+        odin_api.url, cache=ResponseCache(str(tmp_path), ttl=0))
+    start = FakeOdinAPI.FIRST_DAY.isoformat()
+    assert list(scanids.generate_all(1, start)) == odin_api.expected(1)
+    assert len(fetched()) == 10
+    assert list(scanids.generate_all(1, start)) == odin_api.expected(1)
+    # The period info ends before the latest ecmf day and is kept, like the
+    # day logs
+    assert fetched() == []
+    scanids.cache.refresh = True
+    assert list(scanids.generate_all(1, start)) == odin_api.expected(1)
+    assert len(fetched()) == 10
+
+
+def test_period_info_cache_does_not_depend_on_length(odin_api, tmp_path):
+    cache = ResponseCache(str(tmp_path), ttl=0)
+    end = datetime(2015, 1, 10)
+    days = list(ScanIDs(odin_api.url, cache=cache).generate_days_with_scans(
+        datetime(2014, 1, 1), end, 1))
+    assert [day[0] for day in days] == [
+        '2015-01-%02d' % n for n in range(1, 10)]
+    assert any('period_info' in path for path in odin_api.requests)
+    for length, start in ((30, 1), (90, 5), (1000, 9), (365, 12)):
+        del odin_api.requests[:]
+        scanids = ScanIDs(odin_api.url, cache=cache)
+        scanids.period_length.days = length
+        assert list(scanids.generate_days_with_scans(
+            datetime(2014, start, 1), end, 1)) == days
+        assert not [
+            path for path in odin_api.requests if 'period_info' in path]
+
+
+@pytest.mark.parametrize('freq_mode,expect', (
+    ('1', [1]),
+    ('2,1, 2', [1, 2]),
+    ('all', sorted(FREQMODE_TO_BACKEND)),
+    ('ALL', sorted(FREQMODE_TO_BACKEND)),
+    ('1,x', None),
+    ('', None),
+))
+def test_parse_freqmodes(freq_mode, expect):
+    assert qsmrjobs.parse_freqmodes(freq_mode) == expect
+
+
+class BaseTestFakeOdinAPI(BaseTestAddJobs):
+
+    @pytest.fixture(autouse=True)
+    def fake_odin_api(self, jobs, odin_api):  # pylint: disable=unused-argument
+        self._odin_api = odin_api
+        self._write_config((
+            f'ODIN_SECRET={SECRET_KEY}\n'
+            'ODIN_API_ROOT={}\n'.format(odin_api.url)
+            + 'JOB_API_ROOT=http://example.com\n'
+            'JOB_API_USERNAME=testuser\n'
+            'JOB_API_PASSWORD=testpw\n'))
+
+    def _added(self):
+        ids = sorted(
+            job['id'] for jobs in self._mock_post_method.jobs
+            for job in jobs)
+        del self._mock_post_method.jobs[:]
+        return ids
+
+    def _expected(self, freqmode, start=FakeOdinAPI.FIRST_DAY,
+                  end=date(2015, 1, 10)):
+        return sorted(
+            '%d:%d' % (freqmode, scanid)
+            for scanid in self._odin_api.expected(freqmode, start, end))
+
+
+class TestAddSeveralFreqmodes(BaseTestFakeOdinAPI):
+
+    def test_add_all(self):
+        """Test to add all scans of two freqmodes in one run"""
+        with tempfile.TemporaryDirectory() as journal_dir:
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1,2', '--all',
+                '--concurrency', '2', '--journal-dir', journal_dir,
+                '--no-cache',
+            ], CONFIG_FILE)
+        self.assertEqual(exit_code, 0)
+        self.assertEqual(
+            self._added(), sorted(self._expected(1) + self._expected(2)))
+        self.assertEqual(self._odin_api.requests.count(
+            '/v5/config_data/latest_ecmf_file'), 1)
+        # One walk over the period info for both freqmodes
+        period_info = [
+            path for path in self._odin_api.requests if 'period_info' in path]
+        self.assertEqual(len(period_info), len(set(period_info)))
+
+    def test_failing_source(self):
+        """Test that a freqmode whose scan ids can not be fetched does not
+        stop the others"""
+        self._odin_api.log_errors['2/2015-01-05'] = 404
+        with tempfile.TemporaryDirectory() as journal_dir:
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1,2', '--all',
+                '--journal-dir', journal_dir, '--no-cache',
+                '--adaptive-batch-size', '--max-batch-size', '6',
+                '--min-batch-size', '6',
+            ], CONFIG_FILE)
+        self.assertEqual(exit_code, 1)
+        added = self._added()
+        self.assertEqual(
+            [jobid for jobid in added if jobid.startswith('1:')],
+            self._expected(1))
+        self.assertEqual(
+            [jobid for jobid in added if jobid.startswith('2:')],
+            self._expected(2, end=date(2015, 1, 5)))
+
+    def test_failing_period_info(self):
+        """Test that the period info shared by the freqmodes failing is
+        reported"""
+        self._odin_api.period_errors = [404]
+        with tempfile.TemporaryDirectory() as journal_dir, \
+                patch.object(qsmrjobs, 'stderr') as mocked_stderr:
+            exit_code = qsmrjobs.main([
+                PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1,2', '--all',
+                '--journal-dir', journal_dir, '--no-cache',
+            ], CONFIG_FILE)
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(self._added(), [])
+        self.assertTrue(
+            mocked_stderr.write.call_args[0][0].startswith('Failed: Get '))
+
+    def test_jobs_file_needs_single_freqmode(self):
+        """Test that a jobs file can not be added to several freqmodes"""
+        self._write_scanids(['1', '2'])
+        exit_code = qsmrjobs.main([
+            PROJECT_NAME, ODIN_PROJECT, '--freq-mode', 'all', '--jobs-file',
+            JOBS_FILE,
+        ], CONFIG_FILE)
+        self.assertEqual(exit_code, 1)
+        self.assertEqual(self._mock_post_method.jobs, [])
+
+
+class TestSinceLast(BaseTestFakeOdinAPI):
+
+    def test_since_last(self):
+        """Test to only add the days after the last added day"""
+        with tempfile.TemporaryDirectory() as state_dir:
+            args = [
+                PROJECT_NAME, ODIN_PROJECT, '--all', '--since-last',
+                '--no-cache', '--journal-dir', state_dir,
+                '--state-file', os.path.join(state_dir, 'state.sqlite'),
+            ]
+            self.assertEqual(qsmrjobs.main(args + [
+                '--freq-mode', '1', '--end-day', '2015-01-05',
+            ], CONFIG_FILE), 0)
+            self.assertEqual(
+                self._added(), self._expected(1, end=date(2015, 1, 5)))
+
+            qsmrjobs.AddQsmrJobs._post_jobs = Mock(
+                side_effect=Exception('Failed!'))
+            self.assertEqual(qsmrjobs.main(args + [
+                '--freq-mode', '1', '--start-day', '2001-01-01',
+            ], CONFIG_FILE), 1)
+            # Batches that the job service rejects are not added either
+            qsmrjobs.AddQsmrJobs._post_jobs = Mock(
+                return_value=ResponseMock(503))
+            self.assertEqual(qsmrjobs.main(args + [
+                '--freq-mode', '1', '--retries', '0',
+            ], CONFIG_FILE), 1)
+            qsmrjobs.AddQsmrJobs._post_jobs = self._mock_post_method
+
+            self.assertEqual(qsmrjobs.main(args + [
+                '--freq-mode', '1,2', '--start-day', '2015-01-02',
+            ], CONFIG_FILE), 0)
+            self.assertEqual(self._added(), sorted(
+                self._expected(1, start=date(2015, 1, 5))
+                + self._expected(2, start=date(2015, 1, 2))))
+
+            self.assertEqual(qsmrjobs.main(args + [
+                '--freq-mode', '1,2',
+            ], CONFIG_FILE), 0)
+            self.assertEqual(self._added(), [])
+
+    def test_since_last_needs_all(self):
+        """Test that --since-last is refused without --all"""
+        self._write_scanids(['1', '2'])
+        self.assertEqual(qsmrjobs.main([
+            PROJECT_NAME, ODIN_PROJECT, '--freq-mode', '1', '--jobs-file',
+            JOBS_FILE, '--since-last',
+        ], CONFIG_FILE), 1)
+
+
 @pytest.mark.system
 class TestGenerateIds(BaseTestAddJobs):
 
@@ -306,3 +1285,21 @@ def test_encrypt_perserves_message():
     payload = 'hello'
     msg = qsmrjobs.encrypt(payload, secret)
     assert encrypt(msg, secret) == payload
+
+
+@pytest.mark.parametrize('use_pool', (False, True))
+def test_encode_level2_target_parameters(use_pool):
+    secret = base64.b64encode(get_random_bytes(16)).decode("utf8")
+    targets = [(scanid, 1) for scanid in range(25)]
+    if use_pool:
+        with ProcessPoolExecutor(2) as pool:
+            tokens = qsmrjobs.encode_level2_target_parameters(
+                iter(targets), ODIN_PROJECT, secret, executor=pool,
+                chunk_size=10)
+    else:
+        tokens = qsmrjobs.encode_level2_target_parameters(
+            iter(targets), ODIN_PROJECT, secret)
+    assert [json.loads(encrypt(token, secret)) for token in tokens] == [
+        {'ScanID': scanid, 'FreqMode': 1, 'Project': ODIN_PROJECT}
+        for scanid in range(25)
+    ]
@@ -0,0 +1,63 @@
+import json
+
+import pytest
+
+from microq_admin.jobsgenerator.jsonstream import iter_json_array
+
+
+def chunked(data, size):
+    return (data[start:start + size] for start in range(0, len(data), size))
+
+
+@pytest.mark.parametrize('size', (1, 2, 7, 1000))
+def test_iter_json_array(size):
+    document = {
+        'Before': {'VDS': [1, 2], 'Text': 'ä ] } "x"'},
+        'Number': 12345,
+        'VDS': [
+            {'Info': {'ScanID': 7014769646, 'Name': 'åäö'}},
+            123456789,
+            -1.5e3,
+            'ö',
+            [],
+            None,
+        ],
+        'After': [1, 2, 3],
+    }
+    data = json.dumps(document, indent=1, ensure_ascii=False).encode()
+    assert list(iter_json_array(chunked(data, size), 'VDS')) == (
+        document['VDS'])
+
+
+@pytest.mark.parametrize('data,expect', (
+    (b'{}', []),
+    (b'{"VDS": []}', []),
+    (b' { "Other" : 1 } ', []),
+    (b'{"VDS": [17]}', [17]),
+))
+def test_iter_json_array_edge_cases(data, expect):
+    assert list(iter_json_array(chunked(data, 3), 'VDS')) == expect
+
+
+@pytest.mark.parametrize('data', (
+    b'{"VDS": [1, 2',
+    b'{"VDS": [1 2]}',
+    b'[1, 2]',
+))
+def test_iter_json_array_invalid(data):
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunked(data, 3), 'VDS'))
+
+
+def test_iter_json_array_streams():
+    data = json.dumps({'VDS': [{'ScanID': n} for n in range(10000)]})
+    consumed = []
+
+    def chunks():
+        for chunk in chunked(data.encode(), 100):
+            consumed.append(chunk)
+            yield chunk
+    items = iter_json_array(chunks(), 'VDS')
+    assert next(items) == {'ScanID': 0}
+    assert len(consumed) == 1
+    assert sum(1 for _ in items) == 9999
@@ -0,0 +1,72 @@
+import threading
+import time
+
+import pytest
+
+from .utils import SECRET_KEY, StandInServer
+from microq_admin import ratelimit
+from microq_admin.jobsgenerator.qsmrjobs import AddQsmrJobs
+from microq_admin.tokens import TokenManager
+from microq_admin.tools import add_production_jobs
+
+
+@pytest.fixture
+def server():
+    def handle(request, body):  # pylint: disable=unused-argument
+        if request.path == '/token':
+            return 200, {'token': 'token'}
+        with handle.lock:
+            handle.arrivals.append(time.monotonic())
+        return 201, {'Data': []}
+    handle.lock = threading.Lock()
+    handle.arrivals = []
+    server = StandInServer(handle)
+    yield server
+    server.close()
+    ratelimit.configure({})
+
+
+def test_token_bucket_holds_rate():
+    bucket = ratelimit.TokenBucket(100, burst=10)
+    start = time.monotonic()
+    for _ in range(60):
+        bucket.acquire()
+    assert 0.45 < time.monotonic() - start < 0.8
+
+
+def test_requests_per_second_under_concurrency(server):
+    ratelimit.configure({
+        'ODIN_API_ROOT': server.url, 'ODIN_API_REQUESTS_PER_SECOND': '50',
+    })
+
+    def worker():
+        for _ in range(10):
+            add_production_jobs.get(server.url + '/scans', {}, False)
+
+    threads = [threading.Thread(target=worker) for _ in range(10)]
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    arrivals = [arrival - start for arrival in server.handle.arrivals]
+    assert len(arrivals) == 100
+    # A burst of 50 and then 50 per second
+    assert 0.9 < max(arrivals) < 1.6
+    assert len([arrival for arrival in arrivals if arrival < 0.5]) <= 76
+
+
+def test_jobs_per_second_under_concurrency(server):
+    ratelimit.configure({
+        'JOB_API_ROOT': server.url, 'JOB_API_JOBS_PER_SECOND': '2000',
+    })
+    adder = AddQsmrJobs(
+        'project', 'odinproject', 'http://example.com/odin', SECRET_KEY,
+        server.url, 'testuser', 'testpw', concurrency=4,
+        token_manager=TokenManager(server.url, 'u', 'pw', path=None))
+    start = time.monotonic()
+    assert adder.add_jobs(range(5000), 1)
+    elapsed = time.monotonic() - start
+    assert len(server.handle.arrivals) == 5
+    # A burst of 2000 jobs and then 2000 per second
+    assert 1.4 < elapsed < 2.5
@@ -0,0 +1,109 @@
+# pylint: disable=W0212
+import random
+import sys
+import time
+import tracemalloc
+from array import array
+
+import pytest
+
+from microq_admin.jobsgenerator import scanidset
+from microq_admin.jobsgenerator.scanidset import ScanIDSet
+
+
+@pytest.fixture(params=('array', 'numpy'))
+def backend(request, monkeypatch):
+    if request.param == 'numpy':
+        pytest.importorskip('numpy')
+    else:
+        monkeypatch.setattr(scanidset, 'numpy', None)
+    monkeypatch.setattr(scanidset, 'CHUNK_SIZE', 1000)
+    return request.param
+
+
+def random_ids(n, seed):
+    rng = random.Random(seed)
+    return [7000000000 + rng.randrange(10 * n) for _ in range(n)]
+
+
+def test_sorted_unique(backend):  # pylint: disable=unused-argument
+    for ids in ([], [5], [1, 2, 3], [3, 1, 2, 3, 1], [1, 1, 2],
+                random_ids(10000, 1)):
+        scanids = ScanIDSet(ids)
+        assert list(scanids) == sorted(set(ids))
+        assert isinstance(scanids._ids, array)
+        assert scanids.nbytes == 8 * len(scanids)
+
+
+def test_set_algebra(backend):  # pylint: disable=unused-argument
+    first = random_ids(10000, 1)
+    second = random_ids(10000, 2) + first[:100]
+    expected = {
+        'union': set(first) | set(second),
+        'difference': set(first) - set(second),
+        'intersection': set(first) & set(second),
+    }
+    for name, expect in expected.items():
+        result = getattr(ScanIDSet(first), name)(ScanIDSet(second))
+        assert list(result) == sorted(expect)
+        assert getattr(ScanIDSet(first), name)(second) == result
+    assert ScanIDSet(first) - [] == ScanIDSet(first)
+    assert ScanIDSet() - first == []
+    assert ScanIDSet(first) | [] == sorted(set(first))
+
+
+def test_sequence():
+    scanids = ScanIDSet([9, 3, 5, 3])
+    assert scanids == [3, 5, 9]
+    assert scanids != [3, 5]
+    assert scanids == ScanIDSet([3, 5, 9])
+    assert (3 in scanids, 4 in scanids, 10 in scanids) == (True, False, False)
+    assert (scanids[0], scanids[-1], len(scanids)) == (3, 9, 3)
+    assert scanids[1:] == [5, 9]
+    assert isinstance(scanids[1:], ScanIDSet)
+    assert scanids[::-1] == scanids
+
+
+def test_from_file(tmp_path):
+    path = tmp_path / 'scanids.txt'
+    path.write_text('3\n1\n2\n3\n')
+    assert ScanIDSet.from_file(str(path)) == [1, 2, 3]
+
+
+def measure(function):
+    """Return (seconds, peak traced bytes) of a call of function, timed
+    without tracing since that slows down allocations
+    """
+    start = time.perf_counter()
+    function()
+    seconds = time.perf_counter() - start
+    tracemalloc.start()
+    try:
+        function()
+        return seconds, tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+
+@pytest.mark.slow
+def test_benchmark_difference(backend):
+    """Compare the time and memory of the difference of 10M scan ids as
+    sets and as ScanIDSets"""
+    n = 10000000
+    available = range(7000000000, 7000000000 + 2 * n, 2)
+    claimed = range(7000000000, 7000000000 + 2 * n, 3)
+
+    set_time, set_peak = measure(
+        lambda: list(set(available) - set(claimed)))
+    scanidset_time, scanidset_peak = measure(
+        lambda: ScanIDSet(available) - ScanIDSet(claimed))
+    print((
+        '10M scan ids: sets {:.1f} s {:.0f} MB, ScanIDSet ({}) {:.1f} s '
+        '{:.0f} MB').format(
+            set_time, set_peak / 1e6, backend, scanidset_time,
+            scanidset_peak / 1e6), file=sys.stderr)
+    scanids = ScanIDSet(available) - ScanIDSet(claimed)
+    # Every third even offset is claimed
+    assert len(scanids) == n - len(range(0, 2 * n, 6))
+    assert scanids[:4] == [7000000002, 7000000004, 7000000008, 7000000010]
+    assert scanidset_peak * 4 < set_peak
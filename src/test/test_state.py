@@ -0,0 +1,29 @@
+import os
+
+from microq_admin.state import Watermarks
+
+
+def test_watermarks(tmp_path):
+    path = os.path.join(str(tmp_path), 'state', 'state.sqlite')
+    watermarks = Watermarks(path)
+    assert watermarks.get('name', 'key') is None
+    watermarks.set('name', 'key', '2015-01-01')
+    watermarks.set('name', 'key', '2015-01-02')
+    watermarks.set('other', 'key', '7')
+    watermarks.close()
+    watermarks = Watermarks(path)
+    assert watermarks.get('name', 'key') == '2015-01-02'
+    assert watermarks.get('other', 'key') == '7'
+    assert watermarks.get('name', 'other') is None
+
+
+def test_watermark_items(tmp_path):
+    watermarks = Watermarks(os.path.join(str(tmp_path), 'state.sqlite'))
+    watermarks.set('name', 'p1/1', '2015-01-01')
+    watermarks.set('name', 'p1/2', '2015-01-02')
+    watermarks.set('name', 'p11/1', '2015-01-03')
+    watermarks.set('other', 'p1/1', '2015-01-04')
+    assert watermarks.items('name', 'p1/') == {
+        'p1/1': '2015-01-01', 'p1/2': '2015-01-02'}
+    assert len(watermarks.items('name')) == 3
+    assert watermarks.items('name', 'p2/') == {}
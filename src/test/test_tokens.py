@@ -0,0 +1,78 @@
+import os
+import stat
+import time
+from unittest.mock import patch
+
+import pytest
+
+from .utils import StandInServer
+from microq_admin import tokens
+
+
+@pytest.fixture
+def job_api():
+    def handle(request, body):  # pylint: disable=unused-argument
+        handle.calls += 1
+        return 200, {'token': 'token%d' % handle.calls}
+    handle.calls = 0
+    server = StandInServer(handle)
+    yield server
+    server.close()
+
+
+@pytest.fixture(autouse=True)
+def clear_memory_cache():
+    tokens.TokenManager._tokens.clear()
+    yield
+    tokens.TokenManager._tokens.clear()
+
+
+def test_token_is_shared_in_memory(job_api):
+    first = tokens.TokenManager(job_api.url, 'user', 'pw', path=None)
+    second = tokens.TokenManager(job_api.url, 'user', 'pw', path=None)
+    assert first.get()[0] == 'token1'
+    assert second.get()[0] == 'token1'
+    assert job_api.handle.calls == 1
+
+
+def test_token_is_cached_on_disk(job_api, tmp_path):
+    path = str(tmp_path / 'state' / 'tokens.json')
+    token, expires = tokens.TokenManager(
+        job_api.url, 'user', 'pw', path=path).get()
+    assert token == 'token1'
+    assert expires > time.time() + tokens.TOKEN_LIFETIME - 5
+    assert stat.S_IMODE(os.stat(path).st_mode) == 0o600
+
+    # A new invocation reads the token from the file
+    tokens.TokenManager._tokens.clear()
+    manager = tokens.TokenManager(job_api.url, 'user', 'pw', path=path)
+    assert manager.get() == (token, expires)
+    assert job_api.handle.calls == 1
+
+    manager.invalidate(token)
+    tokens.TokenManager._tokens.clear()
+    assert manager.get()[0] == 'token2'
+
+
+def test_invalidate_without_token_leaves_file(job_api, tmp_path):
+    path = str(tmp_path / 'tokens.json')
+    manager = tokens.TokenManager(job_api.url, 'user', 'pw', path=path)
+    manager.invalidate(None)
+    assert not os.path.exists(path)
+
+    manager.get()
+    mtime = os.stat(path).st_mtime_ns
+    tokens.TokenManager(job_api.url, 'other', 'pw', path=path).invalidate(
+        None)
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_token_is_renewed_before_expiry(job_api):
+    manager = tokens.TokenManager(job_api.url, 'user', 'pw', path=None)
+    assert manager.get()[0] == 'token1'
+    with patch.object(tokens, 'TOKEN_LIFETIME', tokens.RENEW_MARGIN + 1):
+        manager.invalidate('token1')
+        assert manager.get()[0] == 'token2'
+        assert manager.get()[0] == 'token2'
+        with patch.object(tokens.time, 'time', return_value=time.time() + 2):
+            assert manager.get()[0] == 'token3'
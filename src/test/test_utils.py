@@ -63,6 +63,18 @@ def test_validate_config_including_optionals(config):
     assert utils.validate_config(config)
 
 
+@pytest.mark.parametrize('key,value,valid', (
+    ('JOB_API_REQUESTS_PER_SECOND', '20', True),
+    ('JOB_API_JOBS_PER_SECOND', '1e4', True),
+    ('ODIN_API_REQUESTS_PER_SECOND', '0.5', True),
+    ('JOB_API_REQUESTS_PER_SECOND', '0', False),
+    ('JOB_API_JOBS_PER_SECOND', 'many', False),
+))
+def test_validate_config_rate_limits(config, key, value, valid):
+    config[key] = value
+    assert utils.validate_config(config) == valid
+
+
 def test_validate_project_name():
     assert utils.validate_project_name('project44')
 
@@ -1 +1,46 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
 SECRET_KEY = 'rc/lY+OQYq6mvI6tCfr+tQ=='
+
+
+class StandInServer:
+    """Local http server standing in for the job api.
+
+    handle(handler, body) is called for every request and should return
+    (status code, json response). The server runs in a thread until
+    close() is called.
+    """
+
+    def __init__(self, handle):
+        outer = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def _respond(self):
+                length = int(self.headers.get('Content-Length', 0))
+                body = self.rfile.read(length)
+                status, data = outer.handle(self, body)
+                payload = json.dumps(data).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(payload)))
+                self.end_headers()
+                self.wfile.write(payload)
+
+            do_GET = do_POST = do_PUT = do_DELETE = _respond
+
+            def log_message(self, *args):  # pylint: disable=arguments-differ
+                pass
+
+        self.handle = handle
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server.daemon_threads = True
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()